@@ -1,39 +1,171 @@
-import requests
+import gzip
+import hashlib
+import json
 import os
-from typing import List, Dict, Any, Tuple
+import tarfile
+import tempfile
+from typing import List, Dict, Any, Tuple, Iterator
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+BASE_URL = os.environ.get("SONAR_API_URL", "http://127.0.0.1:8000/api").rstrip('/')
+# 连接池大小：应不小于同时访问服务器的后台线程数，否则多出的连接用完即关
+HTTP_POOL_SIZE = int(os.environ.get("SONAR_HTTP_POOL_SIZE", "10"))
+# 连接失败和 502/503/504 的重试次数，间隔按 0.5s、1s、2s… 指数退避；POST 只在连接未建立时重试
+HTTP_RETRIES = int(os.environ.get("SONAR_HTTP_RETRIES", "3"))
+HTTP_BACKOFF_FACTOR = 0.5
+# 请求体达到该大小时用 gzip 压缩上传
+GZIP_MIN_BYTES = 1024
+# 服务器每 15 秒至少发送一次心跳，读超时要比它长
+EVENT_READ_TIMEOUT = 30
+HISTORY_PAGE_SIZE = 100
+RESULT_PAGE_SIZE = 500
+EXPORT_CHUNK_SIZE = 64 * 1024
+# 文件数达到该值时打包成一个 tar.gz 上传，而不是每个文件一个 multipart 部分
+ARCHIVE_MIN_FILES = 50
+
+
+class CompressingSession(requests.Session):
+    """较大的请求体以 Content-Encoding: gzip 发送。调用方显式设置了 Content-Encoding 的请求保持原样。"""
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        body = request.body
+        if 'Content-Encoding' in request.headers:
+            if request.headers['Content-Encoding'] == 'identity':
+                del request.headers['Content-Encoding']
+        elif isinstance(body, (bytes, str)) and len(body) >= GZIP_MIN_BYTES:
+            request.body = gzip.compress(body.encode('utf-8') if isinstance(body, str) else body)
+            request.headers['Content-Encoding'] = 'gzip'
+            request.headers['Content-Length'] = str(len(request.body))
+        return super().send(request, **kwargs)
+
 
-BASE_URL = "http://127.0.0.1:8000/api"
+def create_session(pool_size: int = HTTP_POOL_SIZE, retries: int = HTTP_RETRIES) -> requests.Session:
+    """创建带连接池和重试的会话。响应的 gzip 解压由 requests 自动完成。"""
+    new_session = CompressingSession()
+    retry = Retry(total=retries, backoff_factor=HTTP_BACKOFF_FACTOR, status_forcelist=(502, 503, 504),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+    return new_session
 
 
-def start_check(file_paths: List[str], folder_name: str) -> Tuple[Dict[str, Any] | None, str | None]:
-    """开始一个多文件互查任务，并发送文件夹名。"""
+# 所有请求共用一个会话，复用 keep-alive 连接；requests 的会话可以被多个工作线程同时使用
+session = create_session()
+
+
+def _request_error_message(e: requests.exceptions.RequestException) -> str:
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code == 429:
+        return "服务器上排队的任务过多，请稍后重试。"
+    return f"网络请求失败: {e}"
+
+
+def file_sha256(path: str) -> str:
+    """文件内容的 SHA-256，与服务器 CodeSubmission.content_hash 的算法一致。"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(EXPORT_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def negotiate_upload(hashes: List[str]) -> Tuple[List[str] | None, str | None]:
+    """把待提交文件的内容哈希发给服务器，返回服务器尚未保存、需要上传的哈希。"""
+    try:
+        response = session.post(f"{BASE_URL}/check/negotiate", json={'hashes': hashes}, timeout=30)
+        response.raise_for_status()
+        return response.json()['missing'], None
+    except requests.exceptions.RequestException as e:
+        return None, f"上传协商失败: {e}"
+
+
+def start_check(file_paths: List[str], folder_name: str, algorithm: str = "sequence") -> Tuple[
+    Dict[str, Any] | None, str | None]:
+    """开始一个多文件互查任务，并发送文件夹名和比对算法。
+
+    先与服务器协商，只上传服务器还没有的文件，其余文件按清单中的哈希引用；
+    协商失败或全部文件都需要上传且数量较多时，改为上传单个压缩包或逐个上传全部文件。
+    """
+    if not file_paths:
+        return None, "没有提供任何文件。"
+    try:
+        manifest = {os.path.basename(path): file_sha256(path) for path in file_paths}
+    except OSError as e:
+        return None, f"读取文件失败: {e}"
+    missing, _ = negotiate_upload(list(manifest.values()))
+    if missing is not None and len(missing) < len(file_paths):
+        missing = set(missing)
+        to_upload = [path for path in file_paths if manifest[os.path.basename(path)] in missing]
+        result, err, status_code = _post_check(to_upload, folder_name, algorithm, manifest)
+        # 409：协商之后服务器上的记录发生了变化，退回完整上传
+        if status_code != 409:
+            return result, err
+    if len(file_paths) >= ARCHIVE_MIN_FILES:
+        return start_archive_check(file_paths, folder_name, algorithm)
+    result, err, _ = _post_check(file_paths, folder_name, algorithm)
+    return result, err
+
+
+def _post_check(file_paths: List[str], folder_name: str, algorithm: str,
+                manifest: Dict[str, str] | None = None) -> Tuple[Dict[str, Any] | None, str | None, int | None]:
     files_to_send = []
-    data = {'folder_name': folder_name}
+    data = {'folder_name': folder_name, 'algorithm': algorithm}
+    if manifest is not None:
+        data['manifest'] = json.dumps(manifest)
     try:
         for path in file_paths:
             files_to_send.append(('files', (os.path.basename(path), open(path, 'rb'), 'text/plain')))
-        if not files_to_send:
-            return None, "没有提供任何文件。"
-        with requests.Session() as session:
-            response = session.post(f"{BASE_URL}/check", files=files_to_send, data=data, timeout=30)
-            response.raise_for_status()
-        return response.json(), None
+        # 没有文件需要上传时请求体退化为普通表单，服务器同样接受
+        response = session.post(f"{BASE_URL}/check", files=files_to_send, data=data, timeout=30)
+        response.raise_for_status()
+        return response.json(), None, response.status_code
     except requests.exceptions.Timeout:
-        return None, "请求超时。请检查网络或后端服务是否正在运行。"
+        return None, "请求超时。请检查网络或后端服务是否正在运行。", None
     except requests.exceptions.ConnectionError:
-        return None, "连接错误。无法连接到后端服务。"
+        return None, "连接错误。无法连接到后端服务。", None
+    except requests.exceptions.HTTPError as e:
+        return None, _request_error_message(e), e.response.status_code
     except requests.exceptions.RequestException as e:
-        return None, f"网络请求失败: {e}"
+        return None, _request_error_message(e), None
     finally:
         for _, (_, f, _) in files_to_send:
             f.close()
 
 
-def start_one_to_many_check(base_file_path: str, other_file_paths: List[str], folder_name: str) -> Tuple[
+def start_archive_check(file_paths: List[str], folder_name: str, algorithm: str = "sequence") -> Tuple[
     Dict[str, Any] | None, str | None]:
-    """开始一个一对多查重任务，并发送文件夹和文件名。"""
+    """把文件打包成 tar.gz 后作为单个文件上传。压缩包写入临时文件，不在内存中拼接。"""
+    data = {'folder_name': folder_name, 'algorithm': algorithm}
+    try:
+        with tempfile.TemporaryFile() as archive:
+            with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+                for path in file_paths:
+                    tar.add(path, arcname=os.path.basename(path))
+            archive.seek(0)
+            # 压缩包本身已经是 gzip，不再对请求体压缩一遍
+            response = session.post(f"{BASE_URL}/check/archive", data=data, timeout=120,
+                                    headers={'Content-Encoding': 'identity'},
+                                    files={'archive': (f"{folder_name}.tar.gz", archive, 'application/gzip')})
+            response.raise_for_status()
+        return response.json(), None
+    except requests.exceptions.Timeout:
+        return None, "请求超时。请检查网络或后端服务是否正在运行。"
+    except requests.exceptions.ConnectionError:
+        return None, "连接错误。无法连接到后端服务。"
+    except requests.exceptions.RequestException as e:
+        return None, _request_error_message(e)
+    except OSError as e:
+        return None, f"打包文件失败: {e}"
+
+
+def start_one_to_many_check(base_file_path: str, other_file_paths: List[str], folder_name: str,
+                            algorithm: str = "sequence") -> Tuple[Dict[str, Any] | None, str | None]:
+    """开始一个一对多查重任务，并发送文件夹、文件名和比对算法。"""
     files_to_send = []
-    data = {'folder_name': folder_name}
+    data = {'folder_name': folder_name, 'algorithm': algorithm}
     try:
         files_to_send.append(
             ('base_file', (os.path.basename(base_file_path), open(base_file_path, 'rb'), 'text/plain')))
@@ -41,12 +173,11 @@ def start_one_to_many_check(base_file_path: str, other_file_paths: List[str], fo
             files_to_send.append(('other_files', (os.path.basename(path), open(path, 'rb'), 'text/plain')))
         if len(files_to_send) < 2:
             return None, "至少需要一个基准文件和一个对比文件。"
-        with requests.Session() as session:
-            response = session.post(f"{BASE_URL}/check_one", files=files_to_send, data=data, timeout=60)
-            response.raise_for_status()
+        response = session.post(f"{BASE_URL}/check_one", files=files_to_send, data=data, timeout=60)
+        response.raise_for_status()
         return response.json(), None
     except requests.exceptions.RequestException as e:
-        return None, f"网络请求失败: {e}"
+        return None, _request_error_message(e)
     finally:
         for _, file_tuple in files_to_send:
             file_obj = file_tuple[1]
@@ -57,42 +188,71 @@ def start_one_to_many_check(base_file_path: str, other_file_paths: List[str], fo
 def get_task_status(task_id: str) -> Tuple[Dict[str, Any] | None, str | None]:
     """根据任务ID获取查重结果。"""
     try:
-        with requests.Session() as session:
-            response = session.get(f"{BASE_URL}/check/{task_id}", timeout=10)
-            response.raise_for_status()
+        response = session.get(f"{BASE_URL}/check/{task_id}", timeout=10)
+        response.raise_for_status()
         return response.json(), None
     except requests.exceptions.RequestException as e:
         return None, f"获取任务状态失败: {e}"
 
 
+def stream_task_events(task_id: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """订阅任务的 Server-Sent Events，逐个产出 (事件名, 任务状态)。连接失败或中断时抛出 RequestException。"""
+    with session.get(f"{BASE_URL}/check/{task_id}/events", stream=True,
+                     timeout=(10, EVENT_READ_TIMEOUT)) as response:
+        response.raise_for_status()
+        event, data = "message", []
+        for line in response.iter_lines(decode_unicode=True):
+            if line:
+                field, _, value = line.partition(':')
+                if field == 'event':
+                    event = value.strip()
+                elif field == 'data':
+                    data.append(value[1:] if value.startswith(' ') else value)
+                continue
+            # 空行表示一个事件结束；以冒号开头的心跳注释没有 data，直接忽略
+            if data:
+                yield event, json.loads('\n'.join(data))
+            event, data = "message", []
+
+
 def get_comparison_details(result_id: str) -> Tuple[Dict[str, Any] | None, str | None]:
     """根据结果ID获取详细的代码比对数据。"""
     try:
-        with requests.Session() as session:
-            response = session.get(f"{BASE_URL}/comparison/{result_id}", timeout=10)
-            response.raise_for_status()
+        response = session.get(f"{BASE_URL}/comparison/{result_id}", timeout=10)
+        response.raise_for_status()
         return response.json(), None
     except requests.exceptions.RequestException as e:
         return None, f"获取比对详情失败: {e}"
 
 
-def get_history_list() -> Tuple[List[Dict[str, Any]] | None, str | None]:
-    """获取所有历史查询任务的列表。"""
+def get_history_list(cursor: str | None = None, limit: int = HISTORY_PAGE_SIZE
+                     ) -> Tuple[List[Dict[str, Any]] | None, str | None, str | None]:
+    """分页获取历史查询任务列表，返回 (本页记录, 下一页游标, 错误信息)；没有更多记录时游标为 None。"""
+    params = {'limit': limit}
+    if cursor:
+        params['cursor'] = cursor
     try:
-        with requests.Session() as session:
-            response = session.get(f"{BASE_URL}/history", timeout=10)
-            response.raise_for_status()
-        return response.json(), None
+        response = session.get(f"{BASE_URL}/history", params=params, timeout=10)
+        response.raise_for_status()
+        return response.json(), response.headers.get('X-Next-Cursor'), None
     except requests.exceptions.RequestException as e:
-        return None, f"获取历史记录列表失败: {e}"
+        return None, None, f"获取历史记录列表失败: {e}"
 
 
-def get_history_detail(history_id: int) -> Tuple[Dict[str, Any] | None, str | None]:
-    """根据历史ID获取该次任务的详细查重结果。"""
+def get_history_detail(history_id: int, cursor: str | None = None, limit: int = RESULT_PAGE_SIZE,
+                       min_similarity: float | None = None, plagiarized_only: bool = False
+                       ) -> Tuple[Dict[str, Any] | None, str | None]:
+    """分页获取某次任务的查重结果，下一页游标在返回数据的 next_cursor 中。"""
+    params: Dict[str, Any] = {'limit': limit}
+    if cursor:
+        params['cursor'] = cursor
+    if min_similarity is not None:
+        params['min_similarity'] = min_similarity
+    if plagiarized_only:
+        params['plagiarized_only'] = 'true'
     try:
-        with requests.Session() as session:
-            response = session.get(f"{BASE_URL}/history/{history_id}", timeout=10)
-            response.raise_for_status()
+        response = session.get(f"{BASE_URL}/history/{history_id}", params=params, timeout=10)
+        response.raise_for_status()
         return response.json(), None
     except requests.exceptions.RequestException as e:
         return None, f"获取历史详情失败: {e}"
@@ -101,7 +261,7 @@ def get_history_detail(history_id: int) -> Tuple[Dict[str, Any] | None, str | No
 def get_similarity_threshold() -> Tuple[float | None, str | None]:
     """获取当前的相似度阈值。"""
     try:
-        response = requests.get(f"{BASE_URL}/settings/similarity_threshold", timeout=5)
+        response = session.get(f"{BASE_URL}/settings/similarity_threshold", timeout=5)
         response.raise_for_status()
         return response.json()['threshold'], None
     except requests.exceptions.RequestException as e:
@@ -111,8 +271,8 @@ def get_similarity_threshold() -> Tuple[float | None, str | None]:
 def set_similarity_threshold(new_threshold: float) -> Tuple[bool, str | None]:
     """设置新的相似度阈值。"""
     try:
-        response = requests.post(f"{BASE_URL}/settings/similarity_threshold",
-                                 json={"threshold": new_threshold}, timeout=5)
+        response = session.post(f"{BASE_URL}/settings/similarity_threshold",
+                                json={"threshold": new_threshold}, timeout=5)
         response.raise_for_status()
         return True, None
     except requests.exceptions.RequestException as e:
@@ -122,19 +282,26 @@ def set_similarity_threshold(new_threshold: float) -> Tuple[bool, str | None]:
 def update_plagiarism_mark(result_id: str, is_plagiarized: bool) -> str | None:
     """更新一个结果的抄袭标记。"""
     try:
-        response = requests.put(f"{BASE_URL}/results/{result_id}/mark",
-                                json={"plagiarized": is_plagiarized}, timeout=5)
+        response = session.put(f"{BASE_URL}/results/{result_id}/mark",
+                               json={"plagiarized": is_plagiarized}, timeout=5)
         response.raise_for_status()
         return None
     except requests.exceptions.RequestException as e:
         return f"更新标记失败: {e}"
 
 
-def export_plagiarized() -> Tuple[List[Dict[str, Any]] | None, str | None]:
-    """导出所有被标记为抄袭的项。"""
+def stream_plagiarized_export(save_path: str, fmt: str = "ndjson") -> Tuple[int | None, str | None]:
+    """把所有被标记为抄袭的记录以 NDJSON 或 CSV 流式下载并直接写入 save_path，返回写入的记录数。"""
     try:
-        response = requests.get(f"{BASE_URL}/export/plagiarized", timeout=20)
-        response.raise_for_status()
-        return response.json(), None
-    except requests.exceptions.RequestException as e:
+        rows = 0
+        with session.get(f"{BASE_URL}/export/plagiarized/stream", params={'format': fmt}, stream=True,
+                         timeout=(10, 60)) as response:
+            response.raise_for_status()
+            with open(save_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=EXPORT_CHUNK_SIZE):
+                    f.write(chunk)
+                    rows += chunk.count(b'\n')
+        # CSV 的第一行是表头
+        return (rows - 1 if fmt == "csv" else rows), None
+    except (requests.exceptions.RequestException, OSError) as e:
         return None, f"导出失败: {e}"
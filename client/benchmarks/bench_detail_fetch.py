@@ -0,0 +1,64 @@
+"""比较详情请求的两种发送方式：每次新建 requests.Session 与复用 client.session 的连接池。
+
+需要一个已有查重结果的后端服务。在项目根目录下运行：
+python -m client.benchmarks.bench_detail_fetch [--count 1000] [--result-id ID]
+服务器地址取自 SONAR_API_URL，未指定 --result-id 时使用最近一次历史任务的第一条结果。
+"""
+import argparse
+import statistics
+import sys
+import time
+
+import requests
+
+from client.api import client
+
+
+def fetch_with_new_session(result_id: str):
+    """改动前的写法：每个请求一个新会话，也就是一条新的 TCP 连接。"""
+    with requests.Session() as session:
+        response = session.get(f"{client.BASE_URL}/comparison/{result_id}", timeout=10)
+        response.raise_for_status()
+
+
+def fetch_with_pooled_session(result_id: str):
+    response = client.session.get(f"{client.BASE_URL}/comparison/{result_id}", timeout=10)
+    response.raise_for_status()
+
+
+def latest_result_id() -> str:
+    histories, _, err = client.get_history_list(limit=1)
+    if err or not histories:
+        sys.exit(f"没有可用的历史记录，请先运行一次查重: {err or ''}")
+    detail, err = client.get_history_detail(histories[0]['id'], limit=1)
+    if err or not detail['results']:
+        sys.exit(f"最近一次历史任务没有结果: {err or ''}")
+    return detail['results'][0]['result_id']
+
+
+def run(label, fetch, result_id: str, count: int):
+    fetch(result_id)  # 预热：服务器端的比对缓存和客户端连接
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(count):
+        begin = time.perf_counter()
+        fetch(result_id)
+        latencies.append((time.perf_counter() - begin) * 1000)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{label:<14} {count:>6} req  {elapsed:8.2f} s  "
+          f"p50 {statistics.median(latencies):7.2f} ms  p95 {latencies[int(len(latencies) * 0.95) - 1]:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--result-id")
+    args = parser.parse_args()
+    result_id = args.result_id or latest_result_id()
+    run("new session", fetch_with_new_session, result_id, args.count)
+    run("pooled", fetch_with_pooled_session, result_id, args.count)
+
+
+if __name__ == "__main__":
+    main()
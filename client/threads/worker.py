@@ -1,21 +1,27 @@
 import time
 import os
+import requests
 from PyQt6.QtCore import QObject, pyqtSignal, pyqtSlot
 from client.api import client as api_client
 from typing import Dict, Any, List
 
+POLL_INITIAL_DELAY = 0.5
+POLL_MAX_DELAY = 5.0
+
 
 class Worker(QObject):
     finished: pyqtSignal = pyqtSignal()
     success: pyqtSignal = pyqtSignal(list)
     error: pyqtSignal = pyqtSignal(str)
     progress: pyqtSignal = pyqtSignal(str)
+    partial: pyqtSignal = pyqtSignal(list)  # 任务进行中目前得分最高的部分结果
 
-    def __init__(self, mode: int, paths: Dict[str, str], names: Dict[str, str] = None):
+    def __init__(self, mode: int, paths: Dict[str, str], names: Dict[str, str] = None, algorithm: str = "sequence"):
         super().__init__()
         self.mode: int = mode
         self.paths: Dict[str, str] = paths
         self.names: Dict[str, str] = names if names is not None else {}
+        self.algorithm: str = algorithm
         self.is_running: bool = True
 
     @pyqtSlot()
@@ -33,7 +39,7 @@ class Worker(QObject):
                     raise Exception("文件夹内至少需要两个Python文件才能进行互查。")
 
                 folder_name = self.names.get('folder_name', os.path.basename(dir_path))
-                task_data, err = api_client.start_check(file_paths, folder_name=folder_name)
+                task_data, err = api_client.start_check(file_paths, folder_name=folder_name, algorithm=self.algorithm)
 
             elif self.mode == 1:
                 base_file = self.paths.get('base_file')
@@ -47,7 +53,8 @@ class Worker(QObject):
                     raise Exception("对比文件夹内没有任何Python文件。")
 
                 folder_name = self.names.get('folder_name', os.path.basename(compare_dir))
-                task_data, err = api_client.start_one_to_many_check(base_file, other_files, folder_name=folder_name)
+                task_data, err = api_client.start_one_to_many_check(base_file, other_files, folder_name=folder_name,
+                                                                   algorithm=self.algorithm)
 
             if err:
                 raise Exception(err)
@@ -55,50 +62,111 @@ class Worker(QObject):
                 raise Exception("服务器未能成功创建任务。")
             task_id = task_data['task_id']
             self.progress.emit(f"任务已创建 (ID: {task_id[:8]}...). 等待服务器处理...")
-            attempts = 0
-            max_attempts = 120
-            while attempts < max_attempts and self.is_running:
-                status_data, err = api_client.get_task_status(task_id)
-                if err:
-                    time.sleep(0.5)
-                    attempts += 1
-                    continue
-                if status_data and status_data.get('status') == 'completed':
-                    self.progress.emit("分析完成！")
-                    self.success.emit(status_data.get('results', []))
-                    self.finished.emit()
-                    return
-                time.sleep(0.5)
-                attempts += 1
-            if self.is_running:
-                raise Exception("任务处理超时，请稍后再试。")
+            status_data = self.wait_with_events(task_id)
+            if status_data is None and self.is_running:
+                # 事件流不可用（如经过不支持流式响应的代理）时退回轮询
+                status_data = self.wait_with_polling(task_id)
+            if status_data is not None:
+                self.progress.emit("分析完成！")
+                self.success.emit(status_data.get('results', []))
+                self.finished.emit()
+                return
         except Exception as e:
             self.error.emit(str(e))
         finally:
             if self.is_running:
                 self.finished.emit()
 
+    def wait_with_events(self, task_id: str) -> Dict[str, Any] | None:
+        """通过服务器推送等待任务完成，返回完成时的任务状态；推送不可用或中途断开时返回 None。"""
+        try:
+            for event, status_data in api_client.stream_task_events(task_id):
+                if not self.is_running:
+                    return None
+                if event == 'completed':
+                    return status_data
+                if event == 'error':
+                    raise Exception(f"服务器处理任务失败: {status_data.get('error')}")
+                self.report_progress(status_data)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                raise Exception("服务器上找不到该任务，可能服务器已重启。")
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        return None
+
+    def wait_with_polling(self, task_id: str) -> Dict[str, Any] | None:
+        """轮询任务状态直到完成。间隔从 POLL_INITIAL_DELAY 指数增长到 POLL_MAX_DELAY，不设总时长上限。"""
+        delay = POLL_INITIAL_DELAY
+        while self.is_running:
+            status_data, err = api_client.get_task_status(task_id)
+            if not err and status_data:
+                if status_data.get('status') == 'completed':
+                    return status_data
+                if status_data.get('status') == 'error':
+                    raise Exception(f"服务器处理任务失败: {status_data.get('error')}")
+                self.report_progress(status_data)
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX_DELAY)
+        return None
+
+    def report_progress(self, status_data: Dict[str, Any]):
+        """把服务器发布的进度和部分结果转发给界面。"""
+        if status_data.get('status') == 'queued':
+            self.progress.emit("任务排队中，等待服务器上的 worker 处理...")
+            return
+        done, total = status_data.get('pairs_done'), status_data.get('pairs_total')
+        if total:
+            self.progress.emit(f"正在比对：{done}/{total} 对 ({done / total:.0%})")
+        if status_data.get('partial_results'):
+            self.partial.emit(status_data['partial_results'])
+
     def stop(self):
         self.is_running = False
 
 
 class HistoryWorker(QObject):
-    """一个专门用于从后台获取历史记录列表的 Worker。"""
+    """一个专门用于从后台获取一页历史记录列表的 Worker。"""
     finished: pyqtSignal = pyqtSignal()
-    success: pyqtSignal = pyqtSignal(list)
+    success: pyqtSignal = pyqtSignal(list, str)  # (本页记录, 下一页游标，没有更多时为空字符串)
     error: pyqtSignal = pyqtSignal(str)
 
-    def __init__(self):
+    def __init__(self, cursor: str | None = None):
         super().__init__()
+        self.cursor = cursor
 
     @pyqtSlot()
     def run(self):
         """执行网络请求并发送结果信号。"""
         try:
-            history_list, err = api_client.get_history_list()
+            history_list, next_cursor, err = api_client.get_history_list(self.cursor)
+            if err:
+                raise Exception(err)
+            self.success.emit(history_list, next_cursor or "")
+        except Exception as e:
+            self.error.emit(str(e))
+        finally:
+            self.finished.emit()
+
+
+class HistoryDetailWorker(QObject):
+    """在后台获取某次历史任务的一页查重结果，用于滚动到底部时加载更多。"""
+    finished: pyqtSignal = pyqtSignal()
+    success: pyqtSignal = pyqtSignal(int, str, list, str)  # (历史 ID, 请求的游标, 本页结果, 下一页游标)
+    error: pyqtSignal = pyqtSignal(str)
+
+    def __init__(self, history_id: int, cursor: str):
+        super().__init__()
+        self.history_id = history_id
+        self.cursor = cursor
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            details, err = api_client.get_history_detail(self.history_id, cursor=self.cursor)
             if err:
                 raise Exception(err)
-            self.success.emit(history_list)
+            self.success.emit(self.history_id, self.cursor, details.get('results', []), details.get('next_cursor') or "")
         except Exception as e:
             self.error.emit(str(e))
         finally:
@@ -1,14 +1,13 @@
 import datetime
 import os
-import json
 
 import qtawesome as qta
 from PyQt6 import QtCore, QtWidgets
 from PyQt6.QtCore import QThread, pyqtSlot, Qt, QTimer
 from PyQt6.QtWidgets import QMainWindow, QMessageBox, QFileDialog, QTableWidget, QHeaderView, QDoubleSpinBox, QCheckBox, \
-    QWidget, QHBoxLayout
+    QWidget, QHBoxLayout, QComboBox
 
-from client.threads.worker import Worker, HistoryWorker
+from client.threads.worker import Worker, HistoryWorker, HistoryDetailWorker
 from client.api import client
 from client.ui.main_window_ui import Ui_MainWindow
 from client.windows.graph_window import GraphWindow
@@ -90,6 +89,12 @@ class MainWindow(QMainWindow):
 
         self.analysis_results = None
         self.current_analysis_mode = None  # 【新增】存储当前分析模式
+        # 分页加载：历史列表与历史详情各自记录下一页的游标，滚动到底部时再请求
+        self.history_cursor = None
+        self.history_loading = False
+        self.history_detail_id = None
+        self.history_detail_cursor = None
+        self.history_detail_loading = False
 
         # --- UI元素和逻辑初始化 ---
         self._setup_new_ui_elements()
@@ -110,6 +115,8 @@ class MainWindow(QMainWindow):
         self.worker = None
         self.history_thread = None
         self.history_worker = None
+        self.detail_thread = None
+        self.detail_worker = None
 
         self._setup_window_icons()
         self.load_initial_threshold()
@@ -123,6 +130,13 @@ class MainWindow(QMainWindow):
         self.threshold_spinbox.setDecimals(2)
         self.threshold_spinbox.setValue(0.85)
 
+        self.algorithm_label = QtWidgets.QLabel("比对算法:", self.ui.page)
+        self.algorithm_combo = QComboBox(self.ui.page)
+        self.algorithm_combo.addItem("AST 序列匹配", "sequence")
+        self.algorithm_combo.addItem("Winnowing 指纹", "winnowing")
+        self.algorithm_combo.addItem("贪心串覆盖 (GST)", "gst")
+        self.algorithm_combo.addItem("子树哈希 (Merkle)", "merkle")
+
         self.export_button = QtWidgets.QPushButton("导出抄袭项", self.ui.page)
         self.graph_button = QtWidgets.QPushButton("生成关系图", self.ui.page)
         self.graph_button.setEnabled(False)
@@ -130,6 +144,8 @@ class MainWindow(QMainWindow):
         new_controls_layout = QHBoxLayout()
         new_controls_layout.addWidget(self.threshold_label)
         new_controls_layout.addWidget(self.threshold_spinbox)
+        new_controls_layout.addWidget(self.algorithm_label)
+        new_controls_layout.addWidget(self.algorithm_combo)
         new_controls_layout.addStretch()
         new_controls_layout.addWidget(self.graph_button)
         new_controls_layout.addWidget(self.export_button)
@@ -175,6 +191,8 @@ class MainWindow(QMainWindow):
         self.ui.pushButton_3.clicked.connect(self.show_history_page)
         self.ui.table_history.cellClicked.connect(self.go_to_details_page)
         self.history_table.cellClicked.connect(self.on_history_item_clicked)
+        self.history_table.verticalScrollBar().valueChanged.connect(self.on_history_scrolled)
+        self.ui.table_history.verticalScrollBar().valueChanged.connect(self.on_results_scrolled)
         self.threshold_spinbox.valueChanged.connect(self.on_threshold_changed)
         self.threshold_update_timer.timeout.connect(self.update_threshold_on_server)
         self.export_button.clicked.connect(self.export_plagiarized_items)
@@ -184,6 +202,7 @@ class MainWindow(QMainWindow):
         """开始分析前，存储当前模式。"""
         self.graph_button.setEnabled(False)
         self.analysis_results = None
+        self.history_detail_cursor = None
         self.current_analysis_mode = self.ui.stackedWidget.currentIndex()  # 【关键】存储当前模式
 
         paths, names = {}, {}
@@ -201,7 +220,7 @@ class MainWindow(QMainWindow):
         self.ui.btn_start_analysis_mode2.setEnabled(False)
         self.ui.statusbar.showMessage("正在分析中，请稍候...")
         self.thread = QThread()
-        self.worker = Worker(self.current_analysis_mode, paths, names)
+        self.worker = Worker(self.current_analysis_mode, paths, names, self.algorithm_combo.currentData())
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
         self.worker.finished.connect(self.thread.quit)
@@ -209,6 +228,8 @@ class MainWindow(QMainWindow):
         self.thread.finished.connect(self.thread.deleteLater)
         self.worker.success.connect(self.on_analysis_success)
         self.worker.error.connect(self.on_analysis_error)
+        self.worker.progress.connect(self.ui.statusbar.showMessage)
+        self.worker.partial.connect(self.populate_result_table)
         self.thread.start()
 
     @pyqtSlot(list)
@@ -218,6 +239,17 @@ class MainWindow(QMainWindow):
         self.graph_button.setEnabled(True)
         print("分析成功，结果为:", results)
         self.ui.statusbar.showMessage("分析完成！", 5000)
+        self.populate_result_table(results)
+        self.ui.btn_start_analysis_mode1.setEnabled(True)
+        self.ui.btn_start_analysis_mode2.setEnabled(True)
+
+        # 如果是文件夹互查模式，并且有结果，则自动显示关系图
+        if self.current_analysis_mode == 0 and self.analysis_results:
+            self.show_graph_window()
+
+    @pyqtSlot(list)
+    def populate_result_table(self, results):
+        """把结果填入表格。任务进行中收到的部分结果也通过这里逐步刷新。"""
         self.ui.main_stack.setCurrentIndex(0)
 
         self.ui.table_history.setRowCount(0)
@@ -232,17 +264,30 @@ class MainWindow(QMainWindow):
             self.ui.table_history.setSpan(0, 0, 1, 4)
             return
 
-        self.ui.table_history.setRowCount(len(results))
-        for row, res_item in enumerate(results):
+        self.append_result_rows(results)
+
+        header = self.ui.table_history.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        header.setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
+        header.setSectionResizeMode(2, QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(3, QHeaderView.ResizeMode.ResizeToContents)
+
+    def append_result_rows(self, results):
+        """在结果表末尾追加若干行，分页加载的后续页也通过这里追加。"""
+        first_row = self.ui.table_history.rowCount()
+        self.ui.table_history.setRowCount(first_row + len(results))
+        for row, res_item in enumerate(results, start=first_row):
             file1 = res_item.get('file1', '')
             file2 = res_item.get('file2', '')
             similarity = res_item.get('similarity', 0.0)
             result_id = res_item.get('result_id', '')
             is_plagiarized = res_item.get('plagiarized', False)
+            # bounded 的结果只有上界，真实得分低于该值
+            similarity_text = f"< {similarity:.2%}" if res_item.get('bounded') else f"{similarity:.2%}"
 
             item_file1 = QtWidgets.QTableWidgetItem(file1)
             item_file2 = QtWidgets.QTableWidgetItem(file2)
-            item_similarity = QtWidgets.QTableWidgetItem(f"{similarity:.2%}")
+            item_similarity = QtWidgets.QTableWidgetItem(similarity_text)
             item_similarity.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
             item_file1.setData(Qt.ItemDataRole.UserRole, result_id)
 
@@ -262,17 +307,39 @@ class MainWindow(QMainWindow):
             layout.setContentsMargins(0, 0, 0, 0)
             self.ui.table_history.setCellWidget(row, 3, cell_widget)
 
-        header = self.ui.table_history.horizontalHeader()
-        header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(2, QHeaderView.ResizeMode.ResizeToContents)
-        header.setSectionResizeMode(3, QHeaderView.ResizeMode.ResizeToContents)
-        self.ui.btn_start_analysis_mode1.setEnabled(True)
-        self.ui.btn_start_analysis_mode2.setEnabled(True)
+    def on_results_scrolled(self, value):
+        """历史详情滚动到底部且还有下一页时，在后台线程中加载下一页结果。"""
+        scroll_bar = self.ui.table_history.verticalScrollBar()
+        if not self.history_detail_cursor or self.history_detail_loading or value < scroll_bar.maximum():
+            return
+        self.ui.statusbar.showMessage("正在加载更多结果...")
+        self.history_detail_loading = True
+        self.detail_thread = QThread()
+        self.detail_worker = HistoryDetailWorker(self.history_detail_id, self.history_detail_cursor)
+        self.detail_worker.moveToThread(self.detail_thread)
+        self.detail_thread.started.connect(self.detail_worker.run)
+        self.detail_worker.finished.connect(self.detail_thread.quit)
+        self.detail_worker.finished.connect(self.detail_worker.deleteLater)
+        self.detail_thread.finished.connect(self.detail_thread.deleteLater)
+        self.detail_worker.success.connect(self.on_results_page_loaded)
+        self.detail_worker.error.connect(self.on_results_page_error)
+        self.detail_thread.start()
+
+    @pyqtSlot(int, str, list, str)
+    def on_results_page_loaded(self, history_id, cursor, page, next_cursor):
+        self.history_detail_loading = False
+        # 加载期间用户可能已打开其他历史记录或开始了新的分析，这一页已经过时
+        if history_id != self.history_detail_id or cursor != self.history_detail_cursor:
+            return
+        self.history_detail_cursor = next_cursor or None
+        self.analysis_results = (self.analysis_results or []) + page
+        self.append_result_rows(page)
+        self.ui.statusbar.showMessage(f"已加载 {len(self.analysis_results)} 条结果。", 3000)
 
-        # 如果是文件夹互查模式，并且有结果，则自动显示关系图
-        if self.current_analysis_mode == 0 and self.analysis_results:
-            self.show_graph_window()
+    @pyqtSlot(str)
+    def on_results_page_error(self, error_message):
+        self.history_detail_loading = False
+        self.ui.statusbar.showMessage(f"加载更多结果失败: {error_message}", 5000)
 
     def show_graph_window(self):
         """显示抄袭关系网络图窗口。"""
@@ -380,10 +447,22 @@ class MainWindow(QMainWindow):
         self.ui.main_stack.setCurrentIndex(2)
 
     def show_history_page(self):
-        self.ui.statusbar.showMessage("正在加载历史记录...")
         self.ui.pushButton_3.setEnabled(False)
+        self.history_table.setColumnCount(5)
+        self.history_table.setHorizontalHeaderLabels(['查询时间', '类型', '查询文件夹', '基准文件', '描述'])
+        header = self.history_table.horizontalHeader()
+        for i in range(5): header.setSectionResizeMode(i,
+                                                       QHeaderView.ResizeMode.ResizeToContents if i < 2 else QHeaderView.ResizeMode.Stretch)
+        self.history_cursor = None
+        self.history_table.setRowCount(0)
+        self.load_history_page(None)
+
+    def load_history_page(self, cursor):
+        """在后台线程中请求一页历史记录，cursor 为 None 表示第一页。"""
+        self.ui.statusbar.showMessage("正在加载历史记录...")
+        self.history_loading = True
         self.history_thread = QThread()
-        self.history_worker = HistoryWorker()
+        self.history_worker = HistoryWorker(cursor)
         self.history_worker.moveToThread(self.history_thread)
         self.history_thread.started.connect(self.history_worker.run)
         self.history_worker.finished.connect(self.history_thread.quit)
@@ -393,26 +472,27 @@ class MainWindow(QMainWindow):
         self.history_worker.error.connect(self.on_history_load_error)
         self.history_thread.start()
 
-    @pyqtSlot(list)
-    def on_history_load_success(self, history_list):
-        self.history_table.setColumnCount(5)
-        self.history_table.setHorizontalHeaderLabels(['查询时间', '类型', '查询文件夹', '基准文件', '描述'])
-        header = self.history_table.horizontalHeader()
-        for i in range(5): header.setSectionResizeMode(i,
-                                                       QHeaderView.ResizeMode.ResizeToContents if i < 2 else QHeaderView.ResizeMode.Stretch)
-
-        self.history_table.setRowCount(0)
-        if history_list:
-            self.history_table.setRowCount(len(history_list))
-            for row, item in enumerate(history_list):
-                item_time = QtWidgets.QTableWidgetItem(item.get('query_time', '').split('.')[0].replace('T', ' '))
-                item_time.setData(Qt.ItemDataRole.UserRole, item.get('id'))
-                self.history_table.setItem(row, 0, item_time)
-                self.history_table.setItem(row, 1, QtWidgets.QTableWidgetItem(item.get('query_type', '')))
-                self.history_table.setItem(row, 2, QtWidgets.QTableWidgetItem(item.get('folder_name', 'N/A')))
-                self.history_table.setItem(row, 3, QtWidgets.QTableWidgetItem(item.get('special_file_name', 'N/A')))
-                self.history_table.setItem(row, 4, QtWidgets.QTableWidgetItem(item.get('description', '')))
-            self.ui.statusbar.showMessage(f"成功加载 {len(history_list)} 条历史记录。", 5000)
+    def on_history_scrolled(self, value):
+        """历史列表滚动到底部且还有下一页时，加载下一页。"""
+        if self.history_cursor and not self.history_loading and value >= self.history_table.verticalScrollBar().maximum():
+            self.load_history_page(self.history_cursor)
+
+    @pyqtSlot(list, str)
+    def on_history_load_success(self, history_list, next_cursor):
+        self.history_loading = False
+        self.history_cursor = next_cursor or None
+        first_row = self.history_table.rowCount()
+        self.history_table.setRowCount(first_row + len(history_list))
+        for row, item in enumerate(history_list, start=first_row):
+            item_time = QtWidgets.QTableWidgetItem(item.get('query_time', '').split('.')[0].replace('T', ' '))
+            item_time.setData(Qt.ItemDataRole.UserRole, item.get('id'))
+            self.history_table.setItem(row, 0, item_time)
+            self.history_table.setItem(row, 1, QtWidgets.QTableWidgetItem(item.get('query_type', '')))
+            self.history_table.setItem(row, 2, QtWidgets.QTableWidgetItem(item.get('folder_name', 'N/A')))
+            self.history_table.setItem(row, 3, QtWidgets.QTableWidgetItem(item.get('special_file_name', 'N/A')))
+            self.history_table.setItem(row, 4, QtWidgets.QTableWidgetItem(item.get('description', '')))
+        if self.history_table.rowCount():
+            self.ui.statusbar.showMessage(f"成功加载 {self.history_table.rowCount()} 条历史记录。", 5000)
         else:
             self.ui.statusbar.showMessage("没有找到历史记录。", 5000)
 
@@ -421,6 +501,7 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot(str)
     def on_history_load_error(self, error_message):
+        self.history_loading = False
         QMessageBox.critical(self, "加载失败", f"无法加载历史记录: {error_message}")
         self.ui.statusbar.showMessage("加载历史记录失败！", 5000)
         self.ui.pushButton_3.setEnabled(True)
@@ -440,35 +521,34 @@ class MainWindow(QMainWindow):
 
         if 'results' in details:
             self.on_analysis_success(details['results'])
+            self.history_detail_id = history_id
+            self.history_detail_cursor = details.get('next_cursor')
         else:
             print("错误：历史详情数据格式不正确。")
 
     def export_plagiarized_items(self):
-        """导出所有被标记为抄袭的项目。"""
+        """导出所有被标记为抄袭的项目。服务器流式返回，边接收边写入文件，不在内存中保存整个列表。"""
+        save_path, selected_filter = QFileDialog.getSaveFileName(
+            self, "保存导出结果", "plagiarized_results.ndjson", "NDJSON Files (*.ndjson);;CSV Files (*.csv)")
+        if not save_path:
+            return
+        fmt = "csv" if save_path.lower().endswith('.csv') or selected_filter.startswith("CSV") else "ndjson"
+
         self.ui.statusbar.showMessage("正在导出抄袭项...")
-        results, err = client.export_plagiarized()
+        count, err = client.stream_plagiarized_export(save_path, fmt)
         if err:
             QMessageBox.critical(self, "导出失败", err)
             self.ui.statusbar.showMessage("导出失败！", 5000)
             return
 
-        if not results:
+        if not count:
+            os.remove(save_path)
             QMessageBox.information(self, "提示", "当前没有被标记为抄袭的项目可供导出。")
             self.ui.statusbar.showMessage("无项目可导出。", 3000)
             return
 
-        # 弹出文件保存对话框
-        save_path, _ = QFileDialog.getSaveFileName(self, "保存导出结果", "plagiarized_results.json",
-                                                   "JSON Files (*.json)")
-        if save_path:
-            try:
-                with open(save_path, 'w', encoding='utf-8') as f:
-                    json.dump(results, f, indent=4, ensure_ascii=False)
-                self.ui.statusbar.showMessage(f"成功导出到 {save_path}", 5000)
-                QMessageBox.information(self, "导出成功", f"所有标记为抄袭的项目已成功导出到:\n{save_path}")
-            except Exception as e:
-                QMessageBox.critical(self, "保存失败", f"无法将文件写入磁盘: {e}")
-                self.ui.statusbar.showMessage("保存文件失败！", 5000)
+        self.ui.statusbar.showMessage(f"成功导出 {count} 条记录到 {save_path}", 5000)
+        QMessageBox.information(self, "导出成功", f"所有标记为抄袭的项目已成功导出到:\n{save_path}")
 
     # --- 窗口拖动和最大化/最小化/关闭的函数 ---
     def toggle_maximize_restore(self):
@@ -3,11 +3,11 @@
 # ==============================================================================
 #  One-Click Start Script (macOS) - Single Virtual Environment Version
 # ==============================================================================
-# This script opens two new Terminal windows to run the server (backend) and
-# the client (frontend).
+# This script opens three new Terminal windows to run the server (backend),
+# the scoring worker and the client (frontend).
 # ==============================================================================
 
-echo "🚀 Starting FastAPI Server and PyQt6 Client..."
+echo "🚀 Starting FastAPI Server, Scoring Worker and PyQt6 Client..."
 
 # Get the absolute path of the directory where the script is located
 BASE_DIR=$(cd -- "$(dirname -- "$0")" && pwd)
@@ -20,6 +20,12 @@ SERVER_CMD="source '$BASE_DIR/.venv/bin/activate' && \
              echo '--- 🐍 Starting Backend Server ---' && \
              uvicorn main:app --reload"
 
+# WORKER_CMD - checks are queued by the server and executed by this process
+WORKER_CMD="source '$BASE_DIR/.venv/bin/activate' && \
+             cd '$BASE_DIR/server' && \
+             echo '--- ⚙️ Starting Scoring Worker ---' && \
+             python worker.py"
+
 # CLIENT_CMD
 CLIENT_CMD="source '$BASE_DIR/.venv/bin/activate' && \
               cd '$BASE_DIR' && \
@@ -36,9 +42,16 @@ tell application "Terminal"
 end tell
 EOD
 
-# Give it a moment to launch
+# Give it a moment to launch (the server creates the database tables)
 sleep 2
 
+# Open a new terminal window for the scoring worker
+osascript <<EOD
+tell application "Terminal"
+    do script "$WORKER_CMD"
+end tell
+EOD
+
 # Open another new terminal window for the client
 osascript <<EOD
 tell application "Terminal"
@@ -46,5 +59,5 @@ tell application "Terminal"
 end tell
 EOD
 
-echo "✅ Both services have been launched in new Terminal windows."
+echo "✅ All services have been launched in new Terminal windows."
 echo "You can close this initial terminal window."
\ No newline at end of file
@@ -0,0 +1,76 @@
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .core import CodeFingerprint, FingerprintCache, ScoringOptions, PairScore, build_fingerprint, WINNOW_K, WINNOW_WINDOW
+from .models import CodeSubmission, FingerprintPosting
+from .scoring import score_pairs
+from .submissions import sql_chunks
+
+SEARCH_TOP_K = 10
+CANDIDATE_FACTOR = 5  # 精确打分的候选数 = max(k * CANDIDATE_FACTOR, MIN_CANDIDATES)
+MIN_CANDIDATES = 50
+# 出现在过多提交中的指纹（模板代码、main 入口等）区分度很低，倒排表又最长，检索时忽略
+COMMON_HASH_FRACTION = 0.05
+COMMON_HASH_MIN_DF = 100
+
+
+def _document_frequencies(db: Session, hashes: List[int]) -> Dict[int, int]:
+    df = {}
+    for chunk in sql_chunks(hashes):
+        rows = db.query(FingerprintPosting.hash, func.count()).filter(
+            FingerprintPosting.hash.in_(chunk)).group_by(FingerprintPosting.hash).all()
+        df.update(rows)
+    return df
+
+
+def rank_candidates(db: Session, fingerprint: CodeFingerprint, limit: int) -> List[Tuple[int, int]]:
+    """按共享指纹数对归档中的提交排序，返回前 limit 个 (submission_id, 共享指纹数)。"""
+    hashes = list(fingerprint.winnowed(WINNOW_K, WINNOW_WINDOW))
+    total = db.query(func.count(CodeSubmission.id)).filter(CodeSubmission.indexed == True).scalar() or 0
+    max_df = max(COMMON_HASH_MIN_DF, COMMON_HASH_FRACTION * total)
+    selective = [h for h, df in _document_frequencies(db, hashes).items() if df <= max_df]
+
+    shared: Counter = Counter()
+    for chunk in sql_chunks(selective):
+        rows = db.query(FingerprintPosting.submission_id, func.count()).filter(
+            FingerprintPosting.hash.in_(chunk)).group_by(FingerprintPosting.submission_id).all()
+        for submission_id, count in rows:
+            shared[submission_id] += count
+    return shared.most_common(limit)
+
+
+def _load_by_id(db: Session, ids: List[int], cache: FingerprintCache) -> Dict[int, Tuple[CodeSubmission, CodeFingerprint]]:
+    loaded = {}
+    for chunk in sql_chunks(ids):
+        for submission in db.query(CodeSubmission).filter(CodeSubmission.id.in_(chunk)):
+            key = submission.content_hash
+            fingerprint = cache.lookup(key)
+            if fingerprint is None and submission.fingerprint:
+                fingerprint = CodeFingerprint.from_blob(submission.fingerprint, submission.content, key)
+            if fingerprint is None:
+                fingerprint = build_fingerprint(submission.content, key)
+            cache.put(fingerprint)
+            loaded[submission.id] = (submission, fingerprint)
+    return loaded
+
+
+def search_archive(db: Session, fingerprint: CodeFingerprint, k: int, options: ScoringOptions,
+                   cache: FingerprintCache, workers: int = 1) -> Tuple[int, List[Tuple[CodeSubmission, int, PairScore]]]:
+    """在全部历史提交中查找与 fingerprint 最相似的 k 份代码。
+
+    先用倒排索引按共享指纹数挑出少量候选，只对这些候选做精确打分。
+    返回 (候选数, [(提交, 共享指纹数, 得分)])，按得分降序。
+    """
+    candidates = rank_candidates(db, fingerprint, max(k * CANDIDATE_FACTOR, MIN_CANDIDATES))
+    loaded = _load_by_id(db, [submission_id for submission_id, _ in candidates], cache)
+    fingerprints = {None: fingerprint, **{submission_id: fp for submission_id, (_, fp) in loaded.items()}}
+    pairs = [(submission_id, None, submission_id) for submission_id, _ in candidates if submission_id in loaded]
+    scores = score_pairs(fingerprints, pairs, options, workers)
+
+    results = [(loaded[submission_id][0], shared, scores[submission_id])
+               for submission_id, shared in candidates if submission_id in scores]
+    results.sort(key=lambda item: item[2].similarity, reverse=True)
+    return len(candidates), results[:k]
@@ -0,0 +1,180 @@
+import itertools
+import random
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .core import CodeFingerprint, ScoringOptions, METRIC_WINNOWING, NODE_TYPES, NODE_TYPE_CODES
+
+LSH_MIN_FILES = 200  # 文件数达到该值时才启用 LSH 候选剪枝，小任务直接穷举
+NUM_PERM = 128  # MinHash 签名长度
+
+_MINHASH_PRIME = (1 << 31) - 1  # a * x 不会溢出 uint64
+
+CONTROL_FLOW_CODES = frozenset(NODE_TYPE_CODES[name] for name in (
+    'For', 'AsyncFor', 'While', 'If', 'IfExp', 'Try', 'TryStar', 'With', 'AsyncWith', 'Match',
+    'comprehension', 'ExceptHandler', 'match_case'))
+FUNCTION_CODES = frozenset(NODE_TYPE_CODES[name] for name in ('FunctionDef', 'AsyncFunctionDef', 'Lambda'))
+# 节点类型直方图之后的统计量：平均深度、深度标准差、最大深度、控制流节点数、最大控制流嵌套、函数数、最大分支数
+NUM_STATS = 7
+FEATURE_DIM = len(NODE_TYPES) + NUM_STATS
+
+
+def _permutations(num_perm: int) -> Tuple[np.ndarray, np.ndarray]:
+    # 固定种子：同一文件在任何进程、任何任务中得到相同的签名
+    rng = random.Random(1)
+    a = np.array([rng.randint(1, _MINHASH_PRIME - 1) for _ in range(num_perm)], dtype=np.uint64)
+    b = np.array([rng.randint(0, _MINHASH_PRIME - 1) for _ in range(num_perm)], dtype=np.uint64)
+    return a, b
+
+
+_PERM_A, _PERM_B = _permutations(NUM_PERM)
+
+
+def minhash_signature(shingles: Set[int]) -> np.ndarray:
+    """用 NUM_PERM 个线性哈希 (a*x+b) mod p 的最小值近似一个集合。"""
+    if not shingles:
+        return np.full(NUM_PERM, _MINHASH_PRIME, dtype=np.uint64)
+    values = np.fromiter((h % _MINHASH_PRIME for h in shingles), dtype=np.uint64, count=len(shingles))
+    hashed = (np.outer(values, _PERM_A) + _PERM_B) % _MINHASH_PRIME
+    return hashed.min(axis=0)
+
+
+def _collision_probability(s: float, bands: int, rows: int) -> float:
+    return 1.0 - (1.0 - s ** rows) ** bands
+
+
+def lsh_params(jaccard_threshold: float, num_perm: int = NUM_PERM,
+               false_positive_weight: float = 0.1, false_negative_weight: float = 0.9) -> Tuple[int, int]:
+    """选择 (bands, rows)，使阈值两侧的误报/漏报加权面积最小。漏报权重更高，宁可多算几对也不漏掉抄袭。"""
+    steps = 100
+    best, best_error = (num_perm, 1), float('inf')
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        fp = sum(_collision_probability(jaccard_threshold * i / steps, bands, rows)
+                 for i in range(steps)) * jaccard_threshold / steps
+        fn = sum(1.0 - _collision_probability(jaccard_threshold + (1 - jaccard_threshold) * i / steps, bands, rows)
+                 for i in range(steps)) * (1 - jaccard_threshold) / steps
+        error = false_positive_weight * fp + false_negative_weight * fn
+        if error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+def lsh_jaccard_threshold(metric: str, similarity_threshold: float, jaccard_override: float) -> Optional[float]:
+    """决定 LSH 剪枝使用的 winnowing 指纹 Jaccard 阈值，返回 None 表示不剪枝。
+
+    winnowing 算法的得分就是这两组指纹的 Jaccard，阈值可以直接使用相似度阈值。
+    其他算法的得分与指纹 Jaccard 之间没有可靠的换算：插入少量语句就会打断大量 k-gram，
+    例如 test/all/1.py 与 2.py 的 sequence 得分为 0.977，指纹 Jaccard 只有 0.643。
+    因此这些算法默认不剪枝，只有设置了 jaccard_override（大于 0）时才按它剪枝。
+    """
+    if metric == METRIC_WINNOWING:
+        return min(max(similarity_threshold, 0.0), 1.0)
+    return jaccard_override if jaccard_override > 0 else None
+
+
+def lsh_candidate_pairs(filenames: List[str], fingerprints: Dict[str, CodeFingerprint],
+                        jaccard_threshold: float, options: ScoringOptions) -> Set[Tuple[str, str]]:
+    """返回需要精确打分的文件对 (file1, file2)，顺序与 itertools.combinations(filenames, 2) 一致。
+
+    签名取自 options 指定的 winnowing 指纹，jaccard_threshold 由 lsh_jaccard_threshold 给出。
+    解析失败的文件没有 token 流，无法生成签名，它们参与的配对全部保留。
+    """
+    bands, rows = lsh_params(jaccard_threshold)
+    order = {name: i for i, name in enumerate(filenames)}
+    buckets: Dict[Tuple[int, bytes], List[str]] = defaultdict(list)
+    unparsed = []
+    for name in filenames:
+        fp = fingerprints[name]
+        if not fp.parsed:
+            unparsed.append(name)
+            continue
+        signature = minhash_signature(fp.winnowed(options.winnow_k, options.winnow_window))
+        for band in range(bands):
+            buckets[(band, signature[band * rows:(band + 1) * rows].tobytes())].append(name)
+
+    def ordered(a: str, b: str) -> Tuple[str, str]:
+        return (a, b) if order[a] < order[b] else (b, a)
+
+    candidates = set()
+    for members in buckets.values():
+        for a, b in itertools.combinations(members, 2):
+            candidates.add(ordered(a, b))
+    for name in unparsed:
+        for other in filenames:
+            if other != name:
+                candidates.add(ordered(name, other))
+    return candidates
+
+
+def feature_vector(fingerprint: CodeFingerprint) -> np.ndarray:
+    """由规范化 AST 生成定长特征向量：节点类型直方图、深度统计和控制流计数。
+
+    返回未加权的原始计数，加权和归一化由 feature_matrix 按整个任务完成。解析失败的文件返回零向量。
+    """
+    vector = np.zeros(FEATURE_DIM, dtype=np.float32)
+    if not fingerprint.parsed or not len(fingerprint.subtrees.kinds):
+        return vector
+    kinds, sizes = fingerprint.subtrees.kinds, fingerprint.subtrees.sizes
+    vector[:len(NODE_TYPES)] = np.bincount(np.frombuffer(kinds, dtype=np.uint16), minlength=len(NODE_TYPES))
+
+    # 后序下第 i 个节点的后代位于 [i - sizes[i] + 1, i)；逆序扫描，栈中保存祖先子树的起点
+    depths = np.empty(len(kinds), dtype=np.float32)
+    ancestors: List[Tuple[int, bool]] = []
+    flow_depth = max_flow_depth = 0
+    for i in range(len(kinds) - 1, -1, -1):
+        while ancestors and ancestors[-1][0] > i:
+            flow_depth -= ancestors.pop()[1]
+        depths[i] = len(ancestors)
+        is_flow = kinds[i] in CONTROL_FLOW_CODES
+        flow_depth += is_flow
+        max_flow_depth = max(max_flow_depth, flow_depth)
+        ancestors.append((i - sizes[i] + 1, is_flow))
+
+    histogram = vector[:len(NODE_TYPES)]
+    vector[len(NODE_TYPES):] = (
+        depths.mean(), depths.std(), depths.max(),
+        sum(histogram[code] for code in CONTROL_FLOW_CODES), max_flow_depth,
+        sum(histogram[code] for code in FUNCTION_CODES), histogram[NODE_TYPE_CODES['If']],
+    )
+    return vector
+
+
+def feature_matrix(filenames: List[str], fingerprints: Dict[str, CodeFingerprint]) -> np.ndarray:
+    """把一个任务中所有文件的特征向量堆叠成 (文件数, FEATURE_DIM) 的矩阵，行顺序与 filenames 一致。
+
+    与 TF-IDF 相同：计数取 log(1 + x)，节点类型再乘以它在本任务中的逆文档频率，
+    几乎每个文件都有的 Load、Name、Assign 权重最低，少见的节点类型权重更高。
+    最后做 L2 归一化，使任意两行的点积就是余弦相似度。
+    """
+    matrix = np.zeros((len(filenames), FEATURE_DIM), dtype=np.float32)
+    for row, name in enumerate(filenames):
+        matrix[row] = feature_vector(fingerprints[name])
+    histogram = matrix[:, :len(NODE_TYPES)]
+    document_frequency = np.count_nonzero(histogram, axis=0)
+    idf = np.log((1 + len(filenames)) / (1 + document_frequency)) + 1
+    matrix = np.log1p(matrix)
+    matrix[:, :len(NODE_TYPES)] *= idf
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=matrix, where=norms > 0)
+
+
+def cosine_matrix(features: np.ndarray) -> np.ndarray:
+    """一次矩阵乘法得到全部文件两两之间的近似相似度。"""
+    return features @ features.T
+
+
+def prefilter_pairs(filenames: List[str], features: np.ndarray, cutoff: float) -> Set[Tuple[str, str]]:
+    """返回特征余弦相似度不低于 cutoff 的文件对，顺序与 itertools.combinations(filenames, 2) 一致。
+
+    解析失败的文件特征为零向量，它们参与的配对全部保留。
+    """
+    similarities = cosine_matrix(features)
+    keep = similarities >= cutoff
+    unparsed = ~features.any(axis=1)
+    keep[unparsed, :] = True
+    keep[:, unparsed] = True
+    rows, cols = np.nonzero(np.triu(keep, k=1))
+    return {(filenames[i], filenames[j]) for i, j in zip(rows.tolist(), cols.tolist())}
@@ -0,0 +1,54 @@
+import zlib
+
+from fastapi import HTTPException, status
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+GZIP_MIN_SIZE = 1024  # 小于该大小的响应不压缩，压缩头的开销比节省的还多
+MAX_DECOMPRESSED_BODY_BYTES = 512 * 1024 * 1024  # 解压后请求体的大小上限，防止压缩炸弹
+
+
+class GzipRequestMiddleware:
+    """解码 Content-Encoding: gzip 的请求体。
+
+    边接收边解压，下游看到的是普通的未压缩请求，表单/JSON 的解析不受影响。
+    Content-Length 随之去掉，请求体的结束由 more_body 标识。解码错误在路由读取请求体时以 HTTPException 抛出。
+    """
+
+    def __init__(self, app: ASGIApp, max_body_bytes: int = MAX_DECOMPRESSED_BODY_BYTES):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        if headers.get(b"content-encoding", b"").strip().lower() != b"gzip":
+            await self.app(scope, receive, send)
+            return
+
+        scope = dict(scope)
+        scope["headers"] = [(name, value) for name, value in scope["headers"]
+                            if name not in (b"content-encoding", b"content-length")]
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        received = 0
+
+        async def receive_decompressed() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            try:
+                body = decompressor.decompress(message.get("body", b""), self.max_body_bytes - received + 1)
+                if not message.get("more_body", False):
+                    body += decompressor.flush()
+            except zlib.error:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail="Request body is not valid gzip data.")
+            received += len(body)
+            if received > self.max_body_bytes or decompressor.unconsumed_tail:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail="Decompressed request body is too large.")
+            return {"type": "http.request", "body": body, "more_body": message.get("more_body", False)}
+
+        await self.app(scope, receive_decompressed, send)
@@ -1,19 +1,82 @@
 import difflib
 import ast
+import hashlib
+import struct
+import sys
+import zlib
+from array import array
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
+from .cache import LRUCache
 from .schemas import FileDetail, CodeLine
 
 
+# ---------------------------------------------------------------------------
+# 紧凑 token 编码表（uint16）
+#
+#   0      .. 1023   节点类型，编号为 NODE_TYPES 中的下标（0 表示未知节点类型）
+#   1024   .. 49151  规范化标识符 id_N，编码为 IDENTIFIER_BASE + N（超出范围的截断到上限）
+#   49152  .. 65535  属性名、关键字参数名、非字符串常量值以及未规范化的名字，
+#                    编码为 LITERAL_BASE + crc32(文本) % LITERAL_BUCKETS
+# 字符串常量（包括文档字符串）只输出 Constant 节点类型，不输出值。
+#
+# NODE_TYPES 只允许在末尾追加，不能调整已有顺序，否则历史指纹和得分将无法复现。
+# ---------------------------------------------------------------------------
+NODE_TYPES = (
+    '<unknown>',
+    # mod
+    'Module', 'Interactive', 'Expression', 'FunctionType',
+    # stmt
+    'FunctionDef', 'AsyncFunctionDef', 'ClassDef', 'Return', 'Delete', 'Assign', 'TypeAlias', 'AugAssign',
+    'AnnAssign', 'For', 'AsyncFor', 'While', 'If', 'With', 'AsyncWith', 'Match', 'Raise', 'Try', 'TryStar',
+    'Assert', 'Import', 'ImportFrom', 'Global', 'Nonlocal', 'Expr', 'Pass', 'Break', 'Continue',
+    # expr
+    'BoolOp', 'NamedExpr', 'BinOp', 'UnaryOp', 'Lambda', 'IfExp', 'Dict', 'Set', 'ListComp', 'SetComp',
+    'DictComp', 'GeneratorExp', 'Await', 'Yield', 'YieldFrom', 'Compare', 'Call', 'FormattedValue',
+    'JoinedStr', 'Constant', 'Attribute', 'Subscript', 'Starred', 'Name', 'List', 'Tuple', 'Slice',
+    # expr_context / boolop / operator / unaryop / cmpop
+    'Load', 'Store', 'Del', 'And', 'Or',
+    'Add', 'Sub', 'Mult', 'MatMult', 'Div', 'Mod', 'Pow', 'LShift', 'RShift', 'BitOr', 'BitXor', 'BitAnd',
+    'FloorDiv', 'Invert', 'Not', 'UAdd', 'USub',
+    'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'Is', 'IsNot', 'In', 'NotIn',
+    # 其他结构
+    'comprehension', 'ExceptHandler', 'arguments', 'arg', 'keyword', 'alias', 'withitem', 'match_case',
+    'MatchValue', 'MatchSingleton', 'MatchSequence', 'MatchMapping', 'MatchClass', 'MatchStar', 'MatchAs',
+    'MatchOr', 'TypeIgnore', 'TypeVar', 'ParamSpec', 'TypeVarTuple',
+    # 旧版本 / 新版本 Python 才会出现的节点
+    'Index', 'ExtSlice', 'TemplateStr', 'Interpolation',
+)
+NODE_TYPE_CODES = {name: code for code, name in enumerate(NODE_TYPES)}
+IDENTIFIER_BASE = 1024
+LITERAL_BASE = 49152
+LITERAL_BUCKETS = 65536 - LITERAL_BASE
+
+
+def _literal_code(text: str) -> int:
+    return LITERAL_BASE + zlib.crc32(text.encode('utf-8')) % LITERAL_BUCKETS
+
+
+def _constant_code(value) -> Optional[int]:
+    """常量值的编码。字符串（包括文档字符串）只保留类型，返回 None：改写注释、提示文字是最常见的伪装手段。"""
+    if isinstance(value, (str, bytes)):
+        return None
+    return _literal_code(repr(value))
+
+
 class AstNormalizer(ast.NodeTransformer):
 
     def __init__(self):
         self.identifiers = {}
+        self.codes = {}  # 规范化名字 -> 标识符序号，用于生成紧凑 token 流
         self.counter = 0
 
     def get_name(self, name):
         if name not in self.identifiers:
             self.identifiers[name] = f"id_{self.counter}"
+            self.codes[self.identifiers[name]] = self.counter
             self.counter += 1
         return self.identifiers[name]
 
@@ -35,45 +98,578 @@ class AstNormalizer(ast.NodeTransformer):
         node.arg = self.get_name(node.arg)
         return node
 
+    def _name_code(self, name: str) -> int:
+        if name in self.codes:
+            return min(IDENTIFIER_BASE + self.codes[name], LITERAL_BASE - 1)
+        return _literal_code(name)
+
+    def emit_tokens(self, tree: ast.AST) -> Tuple[array, array]:
+        """把本规范化器处理过的 AST 按先序遍历编码为 array('H') token 流，编码规则见 NODE_TYPES 上方的说明。
+
+        同时返回与 token 一一对应的源码行号（array('I')），没有行号的节点沿用父节点的行号。
+        """
+        tokens = array('H')
+        lines = array('I')
+        stack = [(tree, 1)]
+        while stack:
+            node, parent_line = stack.pop()
+            line = getattr(node, 'lineno', parent_line)
+            extra = None
+            if isinstance(node, ast.Name):
+                extra = self._name_code(node.id)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                extra = self._name_code(node.name)
+            elif isinstance(node, ast.arg):
+                extra = self._name_code(node.arg)
+            elif isinstance(node, ast.Attribute):
+                extra = _literal_code(node.attr)
+            elif isinstance(node, ast.keyword) and node.arg:
+                extra = _literal_code(node.arg)
+            elif isinstance(node, ast.Constant):
+                extra = _constant_code(node.value)
+            tokens.append(NODE_TYPE_CODES.get(type(node).__name__, 0))
+            lines.append(line)
+            if extra is not None:
+                tokens.append(extra)
+                lines.append(line)
+            stack.extend((child, line) for child in reversed(list(ast.iter_child_nodes(node))))
+        return tokens, lines
+
+
+METRIC_SEQUENCE = 'sequence'
+METRIC_WINNOWING = 'winnowing'
+METRIC_GST = 'gst'
+METRIC_MERKLE = 'merkle'
+METRICS = (METRIC_SEQUENCE, METRIC_WINNOWING, METRIC_GST, METRIC_MERKLE)
+
+WINNOW_K = 5  # k-gram 长度（以 AST token 计）
+WINNOW_WINDOW = 4  # winnowing 窗口大小
+GST_MIN_MATCH = 12  # Greedy String Tiling 的最小匹配长度（token 数）
+GST_INITIAL_SEARCH = 48  # RKR-GST 的初始搜索长度
+GST_MAX_BUCKET = 64  # 同一窗口哈希在 b 中最多记录的起点数，重复性很强的代码才会超出
+MERKLE_MIN_NODES = 8  # 参与匹配的子树至少包含的节点数，过小的子树（如单个 Name）没有区分度
+
+_HASH_MOD = (1 << 61) - 1  # 梅森素数，哈希值可直接存入 SQLite 的 64 位整数列
+_HASH_BASE = 1_000_003
+
+
+@dataclass
+class ScoringOptions:
+    """一次查重任务的比对参数。"""
+    metric: str = METRIC_SEQUENCE
+    winnow_k: int = WINNOW_K
+    winnow_window: int = WINNOW_WINDOW
+    gst_min_match: int = GST_MIN_MATCH
+    merkle_min_nodes: int = MERKLE_MIN_NODES
+    report_floor: float = 0.0  # 大于 0 时启用上界提前退出：上界低于该值的配对不再精确打分
+
+
+def kgram_hashes(tokens: Sequence[int], k: int) -> List[int]:
+    """用 Karp-Rabin 滚动哈希计算 token 流中所有 k-gram 的哈希值。"""
+    if len(tokens) < k:
+        k = len(tokens)
+    if k == 0:
+        return []
+    top = pow(_HASH_BASE, k - 1, _HASH_MOD)
+    h = 0
+    for v in tokens[:k]:
+        h = (h * _HASH_BASE + v + 1) % _HASH_MOD
+    hashes = [h]
+    for i in range(k, len(tokens)):
+        h = ((h - (tokens[i - k] + 1) * top) * _HASH_BASE + tokens[i] + 1) % _HASH_MOD
+        hashes.append(h)
+    return hashes
+
+
+def winnow(hashes: List[int], window: int) -> Set[int]:
+    """MOSS winnowing：每个长度为 window 的窗口选取最小哈希，得到文档指纹集合。"""
+    if len(hashes) <= window:
+        return {min(hashes)} if hashes else set()
+    return {min(hashes[i:i + window]) for i in range(len(hashes) - window + 1)}
+
+
+def jaccard(a: Set[int], b: Set[int]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class Tile(NamedTuple):
+    """Greedy String Tiling 找到的一段公共 token 串：a[start1:start1+length] == b[start2:start2+length]。"""
+    start1: int
+    start2: int
+    length: int
+
+
+def _unmarked_window_hashes(tokens: Sequence[int], marked: bytearray, length: int):
+    """逐个产出 (起点, 哈希)，只包含完全落在未标记区域内的长度为 length 的窗口。"""
+    top = pow(_HASH_BASE, length - 1, _HASH_MOD)
+    run, h = 0, 0
+    for i, v in enumerate(tokens):
+        if marked[i]:
+            run, h = 0, 0
+            continue
+        if run == length:
+            h = (h - (tokens[i - length] + 1) * top) % _HASH_MOD
+        else:
+            run += 1
+        h = (h * _HASH_BASE + v + 1) % _HASH_MOD
+        if run == length:
+            yield i - length + 1, h
+
+
+def _scan_pattern(a: Sequence[int], b: Sequence[int], marked_a: bytearray, marked_b: bytearray,
+                  length: int) -> Tuple[int, List[Tile]]:
+    # 成百上千条相同语句会让一个窗口哈希对应大量起点，逐一比较和延伸是平方级的。
+    # 这样的哈希只记录前 GST_MAX_BUCKET 个起点，并跳过已被本轮其他匹配覆盖的起点
+    table: Dict[int, List[int]] = {}
+    crowded: Set[int] = set()
+    for j, h in _unmarked_window_hashes(b, marked_b, length):
+        bucket = table.setdefault(h, [])
+        if len(bucket) < GST_MAX_BUCKET:
+            bucket.append(j)
+        else:
+            crowded.add(h)
+    max_match, matches = 0, []
+    diagonal_end: Dict[int, int] = {}  # 对角线 i - j 上已找到的匹配的结束位置
+    covered_b = bytearray(len(b))  # b 中已被本轮匹配覆盖的位置
+    for i, h in _unmarked_window_hashes(a, marked_a, length):
+        for j in table.get(h, ()):
+            if diagonal_end.get(i - j, -1) > i:
+                continue  # 已被同一对角线上更早开始的匹配覆盖，避免重复延伸
+            if h in crowded and covered_b[j]:
+                continue
+            if a[i:i + length] != b[j:j + length]:
+                continue  # 哈希碰撞
+            k = length
+            while (i + k < len(a) and j + k < len(b) and a[i + k] == b[j + k]
+                   and not marked_a[i + k] and not marked_b[j + k]):
+                k += 1
+            diagonal_end[i - j] = i + k
+            covered_b[j:j + k] = b'\x01' * k
+            matches.append(Tile(i, j, k))
+            max_match = max(max_match, k)
+    return max_match, matches
+
+
+def greedy_string_tiling(a: Sequence[int], b: Sequence[int], min_match: int = GST_MIN_MATCH) -> List[Tile]:
+    """JPlag 式 Running-Karp-Rabin Greedy String Tiling。
+
+    每轮用长度为 search 的 Karp-Rabin 哈希在未标记区域中寻找最长公共串，按长度从大到小铺设互不重叠的 tile；
+    search 逐步减半直到 min_match。对调换顺序的函数、语句块不敏感，实际运行接近线性。
+    """
+    marked_a, marked_b = bytearray(len(a)), bytearray(len(b))
+    tiles: List[Tile] = []
+    if min(len(a), len(b)) < min_match:
+        return tiles
+    search = max(min_match, min(GST_INITIAL_SEARCH, len(a), len(b)))
+    while True:
+        max_match, matches = _scan_pattern(a, b, marked_a, marked_b, search)
+        if max_match > 2 * search:
+            search = max_match  # 存在远长于当前搜索长度的匹配，放大搜索长度重新扫描
+            continue
+        new_tiles = 0
+        for tile in sorted(matches, key=lambda t: (-t.length, t.start1, t.start2)):
+            if any(marked_a[tile.start1:tile.start1 + tile.length]) or \
+                    any(marked_b[tile.start2:tile.start2 + tile.length]):
+                continue  # 被更长的 tile 遮挡，剩余部分留给下一轮
+            marked_a[tile.start1:tile.start1 + tile.length] = b'\x01' * tile.length
+            marked_b[tile.start2:tile.start2 + tile.length] = b'\x01' * tile.length
+            tiles.append(tile)
+            new_tiles += 1
+        if new_tiles:
+            continue  # 同一长度下被遮挡的匹配可能还有未标记的部分
+        if search > 2 * min_match:
+            search //= 2
+        elif search > min_match:
+            search = min_match
+        else:
+            return tiles
+
+
+def tiling_similarity(tiles: List[Tile], len1: int, len2: int) -> float:
+    """JPlag 的覆盖率相似度：2 * 被 tile 覆盖的 token 数 / 两个 token 流的总长度。"""
+    if len1 + len2 == 0:
+        return 1.0
+    return 2.0 * sum(tile.length for tile in tiles) / (len1 + len2)
+
+
+# 详细比对中按结构高亮的语句块类型
+BLOCK_NODE_CODES = frozenset(NODE_TYPE_CODES[name] for name in ('FunctionDef', 'For', 'While', 'If', 'With'))
+
+
+@dataclass
+class SubtreeHashes:
+    """AST 每个子树的 Merkle 哈希，按后序排列。
+
+    后序下第 p 个子树的所有后代恰好位于 [p - sizes[p] + 1, p]，因此可以用区间标记“已被匹配覆盖”。
+    """
+    hashes: array  # array('Q')，子树的规范哈希
+    sizes: array  # array('I')，子树包含的节点数
+    kinds: array  # array('H')，根节点类型编码（NODE_TYPES 下标）
+    starts: array  # array('I')，子树覆盖的起始行，0 表示没有位置信息
+    ends: array  # array('I')，子树覆盖的结束行
+
+
+def merkle_subtrees(tree: ast.AST) -> SubtreeHashes:
+    """一次后序遍历计算所有子树的规范哈希，不修改传入的 AST。
+
+    哈希由节点类型、属性名/非字符串常量值以及子节点哈希组成；标识符名一律忽略，因此嵌套的语句块不需要
+    为每个祖先重新规范化、重新序列化。
+    注意这比对每个子树独立做标识符规范化更宽松：标识符之间的对应关系也被丢弃了，
+    例如 x = y + x 与 x = y + y 的哈希相同。匹配结果只用于结构相似度和高亮，这种误配可以接受。
+    """
+    result = SubtreeHashes(array('Q'), array('I'), array('H'), array('I'), array('I'))
+    digests: List[bytes] = []  # 已完成子树的摘要栈
+    stack: List[Tuple[ast.AST, int]] = [(tree, -1)]
+    while stack:
+        node, child_count = stack.pop()
+        if child_count < 0:
+            children = list(ast.iter_child_nodes(node))
+            stack.append((node, len(children)))
+            stack.extend((child, -1) for child in reversed(children))
+            continue
+        code = NODE_TYPE_CODES.get(type(node).__name__, 0)
+        if isinstance(node, ast.Attribute):
+            extra = _literal_code(node.attr)
+        elif isinstance(node, ast.keyword) and node.arg:
+            extra = _literal_code(node.arg)
+        elif isinstance(node, ast.Constant):
+            extra = _constant_code(node.value) or 0
+        else:
+            extra = 0
+        size, start, end = 1, getattr(node, 'lineno', 0), getattr(node, 'end_lineno', None)
+        end = end or start
+        child_digests = digests[len(digests) - child_count:] if child_count else []
+        if child_count:
+            del digests[len(digests) - child_count:]
+        # 子节点在后序中紧挨着排在父节点之前，从后往前按子树大小回溯即可找到每个子节点
+        p = len(result.hashes) - 1
+        for _ in range(child_count):
+            size += result.sizes[p]
+            if result.starts[p]:
+                start = min(start, result.starts[p]) if start else result.starts[p]
+                end = max(end, result.ends[p])
+            p -= result.sizes[p]
+        digest = hashlib.blake2b(code.to_bytes(2, 'little') + extra.to_bytes(2, 'little') + b''.join(child_digests),
+                                 digest_size=8).digest()
+        digests.append(digest)
+        result.hashes.append(int.from_bytes(digest, 'little'))
+        result.sizes.append(size)
+        result.kinds.append(code)
+        result.starts.append(start)
+        result.ends.append(end)
+    return result
+
+
+def merkle_matches(a: SubtreeHashes, b: SubtreeHashes, min_nodes: int = MERKLE_MIN_NODES) -> List[Tuple[int, int]]:
+    """自大到小贪心地配对哈希相同的子树，返回 (a 中的后序下标, b 中的后序下标)。已匹配子树的后代不再参与匹配。"""
+    index_b: Dict[int, List[int]] = {}
+    for q in range(len(b.hashes)):
+        if b.sizes[q] >= min_nodes:
+            index_b.setdefault(b.hashes[q], []).append(q)
+    covered_a, covered_b = bytearray(len(a.hashes)), bytearray(len(b.hashes))
+    matches = []
+    for p in sorted((p for p in range(len(a.hashes)) if a.sizes[p] >= min_nodes), key=lambda p: -a.sizes[p]):
+        if covered_a[p]:
+            continue
+        candidates = index_b.get(a.hashes[p])
+        while candidates and covered_b[candidates[-1]]:
+            candidates.pop()
+        if not candidates:
+            continue
+        q = candidates.pop()
+        size = a.sizes[p]
+        covered_a[p - size + 1:p + 1] = b'\x01' * size
+        covered_b[q - size + 1:q + 1] = b'\x01' * size
+        matches.append((p, q))
+    return matches
+
+
+def merkle_similarity(a: SubtreeHashes, b: SubtreeHashes, matches: List[Tuple[int, int]]) -> float:
+    """2 * 被匹配子树覆盖的节点数 / 两棵树的节点总数。"""
+    total = len(a.hashes) + len(b.hashes)
+    if total == 0:
+        return 1.0
+    return 2.0 * sum(a.sizes[p] for p, _ in matches) / total
+
+
+@dataclass
+class CodeFingerprint:
+    """单个文件的解析产物。每个文件只解析、规范化、序列化一次，之后所有配对都复用它。"""
+    content_hash: str
+    code: str
+    tokens: Optional[array] = None  # 规范化 AST 的紧凑 token 流（array('H')）；解析失败时为 None
+    lines: Optional[array] = None  # 每个 token 对应的源码行号（array('I')）
+    subtrees: Optional[SubtreeHashes] = None  # 每个子树的 Merkle 哈希
+    _winnowed: Dict[Tuple[int, int], Set[int]] = field(default_factory=dict, repr=False)
+    _structure: Optional[array] = field(default=None, repr=False)
+    _histograms: Dict[str, Counter] = field(default_factory=dict, repr=False)
+
+    @property
+    def parsed(self) -> bool:
+        return self.tokens is not None
+
+    @property
+    def structure_tokens(self) -> array:
+        """把所有规范化标识符折叠成同一个编码的 token 流。
+
+        id_N 按首次出现顺序编号，函数调换顺序后编号整体错位；GST 要对重排鲁棒，只能比较结构。
+        """
+        if self._structure is None:
+            self._structure = array('H', (IDENTIFIER_BASE if IDENTIFIER_BASE <= v < LITERAL_BASE else v
+                                          for v in self.tokens or ()))
+        return self._structure
+
+    def histogram(self, structure: bool = False) -> Counter:
+        """token 编码的直方图，用于计算相似度上界；按需计算并缓存。"""
+        key = 'structure' if structure else 'tokens'
+        if key not in self._histograms:
+            self._histograms[key] = Counter(self.structure_tokens if structure else self.tokens or ())
+        return self._histograms[key]
+
+    def winnowed(self, k: int = WINNOW_K, window: int = WINNOW_WINDOW) -> Set[int]:
+        """按 (k, window) 惰性计算并缓存 winnowing 指纹集合。
+
+        与 GST 一样基于 structure_tokens：id_N 的编号随定义顺序变化，直接对 tokens 取 k-gram 时，
+        调换函数顺序就会让几乎所有指纹失配。倒排索引和 LSH 签名也使用这组指纹。
+        """
+        key = (k, window)
+        if key not in self._winnowed:
+            self._winnowed[key] = winnow(kgram_hashes(self.structure_tokens, k), window)
+        return self._winnowed[key]
 
-def calculate_similarity(code1: str, code2: str) -> float:
+    def to_blob(self) -> bytes:
+        """序列化为紧凑的二进制块（见 _BLOB_HEADER），用于存入 CodeSubmission.fingerprint。"""
+        if not self.parsed:
+            return zlib.compress(_BLOB_HEADER.pack(BLOB_VERSION, 0, *([0] * len(_BLOB_ARRAYS))))
+        arrays = [self.tokens, self.lines, self.subtrees.hashes, self.subtrees.sizes, self.subtrees.kinds,
+                  self.subtrees.starts, self.subtrees.ends, array('Q', sorted(self.winnowed()))]
+        header = _BLOB_HEADER.pack(BLOB_VERSION, 1, *(len(a) for a in arrays))
+        return zlib.compress(header + b''.join(_to_little_endian(a) for a in arrays))
+
+    @classmethod
+    def from_blob(cls, blob: bytes, code: str, code_hash: str) -> Optional['CodeFingerprint']:
+        """从 to_blob 的结果还原指纹；版本不符时返回 None，调用方应重新解析。"""
+        data = zlib.decompress(blob)
+        version, parsed, *counts = _BLOB_HEADER.unpack_from(data)
+        if version != BLOB_VERSION:
+            return None
+        fingerprint = cls(content_hash=code_hash, code=code)
+        if not parsed:
+            return fingerprint
+        arrays, offset = [], _BLOB_HEADER.size
+        for typecode, count in zip(_BLOB_ARRAYS, counts):
+            a = array(typecode)
+            a.frombytes(data[offset:offset + count * a.itemsize])
+            if sys.byteorder == 'big':
+                a.byteswap()
+            arrays.append(a)
+            offset += count * a.itemsize
+        fingerprint.tokens, fingerprint.lines = arrays[0], arrays[1]
+        fingerprint.subtrees = SubtreeHashes(*arrays[2:7])
+        fingerprint._winnowed[(WINNOW_K, WINNOW_WINDOW)] = set(arrays[7])
+        return fingerprint
+
+
+# 指纹二进制块格式（zlib 压缩后存储）：
+#   头部 _BLOB_HEADER：版本号、是否解析成功、以及下列 8 个数组各自的元素个数
+#   随后依次为小端字节序的 tokens、lines、子树 hashes/sizes/kinds/starts/ends、默认参数下的 winnowing 指纹
+# token 编码表或数组布局变化时必须递增 BLOB_VERSION，旧记录会被自动重新解析。
+BLOB_VERSION = 4
+_BLOB_ARRAYS = ('H', 'I', 'Q', 'I', 'H', 'I', 'I', 'Q')
+_BLOB_HEADER = struct.Struct('<BB' + 'I' * len(_BLOB_ARRAYS))
+
+
+def _to_little_endian(a: array) -> bytes:
+    if sys.byteorder == 'big':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def content_hash(code: str) -> str:
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def build_fingerprint(code: str, code_hash: Optional[str] = None) -> CodeFingerprint:
+    """解析并规范化一份代码。解析失败的文件只保留原文，比对时走 TF-IDF 回退。"""
+    fingerprint = CodeFingerprint(content_hash=code_hash or content_hash(code), code=code)
     try:
-        tree1 = ast.parse(code1)
-        tree2 = ast.parse(code2)
-        normalizer1 = AstNormalizer()
-        normalized_tree1 = normalizer1.visit(tree1)
-        normalizer2 = AstNormalizer()
-        normalized_tree2 = normalizer2.visit(tree2)
-        normalized_code1 = ast.dump(normalized_tree1)
-        normalized_code2 = ast.dump(normalized_tree2)
-        seq_matcher = difflib.SequenceMatcher(None, normalized_code1, normalized_code2)
-        return seq_matcher.ratio()
+        tree = ast.parse(code)
+        normalizer = AstNormalizer()
+        normalized_tree = normalizer.visit(tree)
+        fingerprint.tokens, fingerprint.lines = normalizer.emit_tokens(normalized_tree)
+        fingerprint.subtrees = merkle_subtrees(normalized_tree)
     except (SyntaxError, Exception):
-        try:
-            vectorizer = TfidfVectorizer(token_pattern=r'(?u)\b\w+\b')
-            tfidf_matrix = vectorizer.fit_transform([code1, code2])
-            similarity = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])
-            return float(similarity[0][0])
-        except ValueError:
-            return 0.0
+        pass
+    return fingerprint
+
+
+class FingerprintCache:
+    """按内容哈希缓存 CodeFingerprint 的 LRU 缓存，可在多个任务之间共享。"""
+
+    def __init__(self, max_entries: int = 4096):
+        self._entries = LRUCache(max_entries)
+
+    def get(self, code: str) -> CodeFingerprint:
+        key = content_hash(code)
+        fingerprint = self._entries.get(key)
+        if fingerprint is None:
+            fingerprint = build_fingerprint(code, key)
+            self._entries.put(key, fingerprint)
+        return fingerprint
+
+    def lookup(self, key: str) -> Optional[CodeFingerprint]:
+        return self._entries.get(key)
+
+    def put(self, fingerprint: CodeFingerprint):
+        self._entries.put(fingerprint.content_hash, fingerprint)
+
+    def clear(self):
+        self._entries.clear()
+
+
+# 跨任务共享的指纹缓存：同一份起始代码或重复提交的文件不必再次解析
+fingerprint_cache = FingerprintCache()
+
+
+class PairScore(NamedTuple):
+    """一个配对的打分结果。bounded 为 True 时 similarity 只是上界，精确得分被提前退出跳过。"""
+    similarity: float
+    matches: Optional[list] = None
+    bounded: bool = False
+
+
+def _length_bound(len1: int, len2: int) -> float:
+    # 与 SequenceMatcher.real_quick_ratio() 相同：匹配长度不可能超过较短的一方
+    return 2.0 * min(len1, len2) / (len1 + len2) if len1 + len2 else 1.0
+
+
+def _histogram_bound(h1: Counter, h2: Counter, len1: int, len2: int) -> float:
+    # 与 SequenceMatcher.quick_ratio() 相同，但直方图已预先算好，每对只需 O(不同编码数)
+    if len1 + len2 == 0:
+        return 1.0
+    if len(h1) > len(h2):
+        h1, h2 = h2, h1
+    return 2.0 * sum(min(count, h2[code]) for code, count in h1.items()) / (len1 + len2)
+
+
+def similarity_upper_bound(fp1: CodeFingerprint, fp2: CodeFingerprint, options: ScoringOptions) -> float:
+    """按代价由低到高计算当前算法得分的上界，一旦低于 report_floor 立即返回。"""
+    floor = options.report_floor
+    if options.metric == METRIC_WINNOWING:
+        a = fp1.winnowed(options.winnow_k, options.winnow_window)
+        b = fp2.winnowed(options.winnow_k, options.winnow_window)
+        return min(len(a), len(b)) / max(len(a), len(b)) if a or b else 1.0
+    if options.metric == METRIC_MERKLE:
+        return _length_bound(len(fp1.subtrees.hashes), len(fp2.subtrees.hashes))
+    len1, len2 = len(fp1.tokens), len(fp2.tokens)
+    bound = _length_bound(len1, len2)
+    if bound < floor:
+        return bound
+    structure = options.metric == METRIC_GST
+    return min(bound, _histogram_bound(fp1.histogram(structure), fp2.histogram(structure), len1, len2))
+
+
+def score_fingerprints(fp1: CodeFingerprint, fp2: CodeFingerprint, options: ScoringOptions) -> PairScore:
+    """启用 report_floor 时先用廉价上界筛掉不可能达到报告下限的配对，其余配对精确打分。"""
+    if options.report_floor > 0 and fp1.parsed and fp2.parsed:
+        bound = similarity_upper_bound(fp1, fp2, options)
+        if bound < options.report_floor:
+            return PairScore(bound, None, True)
+    return PairScore(*match_fingerprints(fp1, fp2, options))
+
+
+def match_fingerprints(fp1: CodeFingerprint, fp2: CodeFingerprint,
+                       options: Optional[ScoringOptions] = None) -> Tuple[float, Optional[list]]:
+    """打分并返回产生该得分的匹配：GST 返回 Tile 列表，Merkle 返回子树下标对，其余算法第二项为 None。"""
+    options = options or ScoringOptions()
+    if fp1.parsed and fp2.parsed:
+        if options.metric == METRIC_GST:
+            tiles = greedy_string_tiling(fp1.structure_tokens, fp2.structure_tokens, options.gst_min_match)
+            return tiling_similarity(tiles, len(fp1.tokens), len(fp2.tokens)), tiles
+        if options.metric == METRIC_MERKLE:
+            matches = merkle_matches(fp1.subtrees, fp2.subtrees, options.merkle_min_nodes)
+            return merkle_similarity(fp1.subtrees, fp2.subtrees, matches), matches
+    return compare_fingerprints(fp1, fp2, options), None
+
+
+def compare_fingerprints(fp1: CodeFingerprint, fp2: CodeFingerprint,
+                         options: Optional[ScoringOptions] = None) -> float:
+    """只做匹配工作：两份文件的解析结果都已在指纹中准备好。"""
+    options = options or ScoringOptions()
+    if fp1.parsed and fp2.parsed:
+        if options.metric in (METRIC_GST, METRIC_MERKLE):
+            return match_fingerprints(fp1, fp2, options)[0]
+        if options.metric == METRIC_WINNOWING:
+            return jaccard(fp1.winnowed(options.winnow_k, options.winnow_window),
+                           fp2.winnowed(options.winnow_k, options.winnow_window))
+        seq_matcher = difflib.SequenceMatcher(None, fp1.tokens, fp2.tokens, autojunk=False)
+        return seq_matcher.ratio()
+    try:
+        vectorizer = TfidfVectorizer(token_pattern=r'(?u)\b\w+\b')
+        tfidf_matrix = vectorizer.fit_transform([fp1.code, fp2.code])
+        similarity = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])
+        return float(similarity[0][0])
+    except ValueError:
+        return 0.0
+
+
+def batch_fallback_similarities(fingerprints: Dict[str, CodeFingerprint],
+                                pairs: List[Tuple[str, str]]) -> Dict[Tuple[str, str], float]:
+    """为无法解析的文件批量计算 TF-IDF 余弦相似度。
+
+    整个任务只拟合一个 TfidfVectorizer，所有回退配对的得分来自一次稀疏矩阵乘法 X_u @ X.T
+    （X_u 为解析失败文件的行）。IDF 基于任务内全部相关文件统计，而非逐对拟合。
+    """
+    if not pairs:
+        return {}
+    names = list(dict.fromkeys(name for pair in pairs for name in pair))
+    row = {name: i for i, name in enumerate(names)}
+    unparsed = [name for name in names if not fingerprints[name].parsed]
+    unparsed_row = {name: i for i, name in enumerate(unparsed)}
+    try:
+        vectorizer = TfidfVectorizer(token_pattern=r'(?u)\b\w+\b')
+        tfidf_matrix = vectorizer.fit_transform([fingerprints[name].code for name in names])
+    except ValueError:
+        return {pair: 0.0 for pair in pairs}
+    # TfidfVectorizer 默认对每行做 L2 归一化，点积即余弦相似度
+    similarity = (tfidf_matrix[[row[name] for name in unparsed]] @ tfidf_matrix.T).tocsr()
+
+    scores = {}
+    for file1, file2 in pairs:
+        if file1 in unparsed_row:
+            value = similarity[unparsed_row[file1], row[file2]]
+        else:
+            value = similarity[unparsed_row[file2], row[file1]]
+        scores[(file1, file2)] = float(value)
+    return scores
+
+
+def calculate_similarity(code1: str, code2: str, options: Optional[ScoringOptions] = None) -> float:
+    return compare_fingerprints(build_fingerprint(code1), build_fingerprint(code2), options)
+
+
+def _mark_lines(code: str, ranges: List[Tuple[int, int]]) -> List[CodeLine]:
+    code_lines = code.splitlines()
+    matched = [False] * len(code_lines)
+    for start, end in ranges:
+        for i in range(start - 1, end):
+            if 0 <= i < len(matched):
+                matched[i] = True
+    return [CodeLine(line_num=i + 1, text=line, status='similar' if matched[i] else 'unique')
+            for i, line in enumerate(code_lines)]
 
 
 def generate_detailed_diff(file1_name: str, code1: str, file2_name: str, code2: str) -> dict:
     def get_normalized_node_map(code):
-        tree = ast.parse(code)
+        # 一次后序遍历得到所有子树的规范哈希，语句块的哈希即其结构的“指纹”
+        subtrees = merkle_subtrees(ast.parse(code))
         node_map = {}
-        for node in ast.walk(tree):
-            if isinstance(node, (ast.FunctionDef, ast.For, ast.While, ast.If, ast.With)):
-                # 规范化节点以获得其结构
-                normalized_node = AstNormalizer().visit(node)
-                # 使用 ast.dump 作为该节点结构的“哈希”
-                node_key = ast.dump(normalized_node)
-                # 记录该结构对应的行号范围
-                start_line = node.lineno
-                end_line = getattr(node, 'end_lineno', start_line)
-                if node_key not in node_map:
-                    node_map[node_key] = []
-                node_map[node_key].append((start_line, end_line))
+        for p, kind in enumerate(subtrees.kinds):
+            if kind in BLOCK_NODE_CODES:
+                node_map.setdefault(subtrees.hashes[p], []).append((subtrees.starts[p], subtrees.ends[p]))
         return node_map
 
     try:
@@ -86,28 +682,30 @@ def generate_detailed_diff(file1_name: str, code1: str, file2_name: str, code2:
     # 查找两个文件中都存在的相同结构
     common_keys = set(map1.keys()) & set(map2.keys())
 
-    matched_lines1 = [False] * len(code1.splitlines())
-    for key in common_keys:
-        for start, end in map1[key]:
-            for i in range(start - 1, end):
-                if i < len(matched_lines1):
-                    matched_lines1[i] = True
-
-    matched_lines2 = [False] * len(code2.splitlines())
-    for key in common_keys:
-        for start, end in map2[key]:
-            for i in range(start - 1, end):
-                if i < len(matched_lines2):
-                    matched_lines2[i] = True
-
-    file1_lines = [CodeLine(line_num=i + 1, text=line, status='similar' if matched_lines1[i] else 'unique') for i, line
-                   in enumerate(code1.splitlines())]
-    file2_lines = [CodeLine(line_num=i + 1, text=line, status='similar' if matched_lines2[i] else 'unique') for i, line
-                   in enumerate(code2.splitlines())]
+    return {
+        "file1_details": FileDetail(name=file1_name,
+                                    lines=_mark_lines(code1, [r for key in common_keys for r in map1[key]])),
+        "file2_details": FileDetail(name=file2_name,
+                                    lines=_mark_lines(code2, [r for key in common_keys for r in map2[key]]))
+    }
+
+
+def _token_line_ranges(token_lines: Sequence[int], spans: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    return [(line, line) for start, length in spans for line in set(token_lines[start:start + length])]
+
 
+def generate_match_diff(file1_name: str, fp1: CodeFingerprint, file2_name: str, fp2: CodeFingerprint,
+                        metric: str, matches: list) -> dict:
+    """直接用打分时找到的匹配（GST 的 tile 或 Merkle 的子树对）高亮代码行，不再对两份代码做第二次比对。"""
+    if metric == METRIC_GST:
+        ranges1 = _token_line_ranges(fp1.lines, [(t.start1, t.length) for t in matches])
+        ranges2 = _token_line_ranges(fp2.lines, [(t.start2, t.length) for t in matches])
+    else:
+        ranges1 = [(fp1.subtrees.starts[p], fp1.subtrees.ends[p]) for p, _ in matches]
+        ranges2 = [(fp2.subtrees.starts[q], fp2.subtrees.ends[q]) for _, q in matches]
     return {
-        "file1_details": FileDetail(name=file1_name, lines=file1_lines),
-        "file2_details": FileDetail(name=file2_name, lines=file2_lines)
+        "file1_details": FileDetail(name=file1_name, lines=_mark_lines(fp1.code, ranges1)),
+        "file2_details": FileDetail(name=file2_name, lines=_mark_lines(fp2.code, ranges2))
     }
 
 
@@ -1,19 +1,77 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker
 from .models import Base, Setting
 
 DATABASE_URL = "sqlite:///./a.db"
 
+# 存储配置，通过环境变量 SONAR_SQLITE_PROFILE 选择：
+#   wal     - WAL 日志 + synchronous=NORMAL，读请求不再被大批量结果写入阻塞；并开启 mmap 与更大的页缓存
+#   default - 不设置任何 PRAGMA，即 SQLite 的默认行为（回滚日志、synchronous=FULL）
+SQLITE_PROFILES = {
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64000,  # 负数表示以 KiB 为单位，约 64 MB
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,  # 毫秒，写锁被占用时等待而不是立即报 database is locked
+    },
+    "default": {},
+}
+SQLITE_PROFILE = os.environ.get("SONAR_SQLITE_PROFILE", "wal")
+if SQLITE_PROFILE not in SQLITE_PROFILES:
+    raise ValueError(f"Unknown SONAR_SQLITE_PROFILE '{SQLITE_PROFILE}'. Choose one of: {', '.join(SQLITE_PROFILES)}.")
+
 engine = create_engine(
     DATABASE_URL,
     connect_args={"check_same_thread": False}
 )
 
+
+@event.listens_for(engine, "connect")
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PROFILES[SQLITE_PROFILE].items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
+def add_missing_columns():
+    """为已存在的旧表补上模型中新增的列。create_all 只建新表，不会修改已有表结构。"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                conn.execute(text(ddl))
+                print(f"Added column {table.name}.{column.name}.")
+
+
+def add_missing_indexes():
+    """为已存在的旧表补上模型中新增的索引。"""
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+
 def create_db_and_tables():
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    add_missing_indexes()
 
     db = SessionLocal()
     try:
@@ -0,0 +1,123 @@
+import datetime
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import exists, func, update
+from sqlalchemy.orm import Session, aliased
+
+from .models import Job
+
+# 任务状态，与 TaskStatusResponse.status 一致
+JOB_QUEUED = 'queued'
+JOB_PROCESSING = 'processing'
+JOB_COMPLETED = 'completed'
+JOB_ERROR = 'error'
+
+JOB_FOLDER = 'folder'
+JOB_ONE_TO_MANY = 'one_to_many'
+JOB_INCREMENTAL = 'incremental'
+
+# 可通过环境变量调整
+QUEUE_MAX_DEPTH = int(os.environ.get("SONAR_QUEUE_MAX_DEPTH", "100"))  # 排队中的任务达到该数量时拒绝新任务（429）
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("SONAR_JOB_HEARTBEAT_SECONDS", "5"))
+# 超过该时长没有心跳的任务视为 worker 已崩溃，重新排队
+JOB_STALE_SECONDS = float(os.environ.get("SONAR_JOB_STALE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("SONAR_JOB_MAX_ATTEMPTS", "3"))  # 连续崩溃达到该次数的任务标记为失败
+
+
+class QueueFullError(Exception):
+    """排队中的任务过多，调用方应稍后重试。"""
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _update_jobs(*criteria):
+    # 直接执行 UPDATE，不回头同步会话中已加载的 Job 对象
+    return update(Job).where(*criteria).execution_options(synchronize_session=False)
+
+
+def queue_depth(db: Session) -> int:
+    return db.query(func.count(Job.id)).filter(Job.status == JOB_QUEUED).scalar()
+
+
+def enqueue_job(db: Session, task_id: str, kind: str, payload: Dict[str, Any], priority: int = 0,
+                max_depth: int = QUEUE_MAX_DEPTH) -> Job:
+    """把任务写入队列并提交。排队中的任务已达 max_depth 时抛出 QueueFullError。"""
+    if queue_depth(db) >= max_depth:
+        raise QueueFullError()
+    job = Job(task_id=task_id, kind=kind, priority=priority, status=JOB_QUEUED, payload=json.dumps(payload),
+              history_id=payload.get('history_id') if kind == JOB_INCREMENTAL else None)
+    db.add(job)
+    db.commit()
+    return job
+
+
+def claim_job(db: Session, worker_id: str) -> Optional[Job]:
+    """认领优先级最高、入队最早的一个排队任务，没有可认领的任务时返回 None。
+
+    先选出候选再用带 status 条件的 UPDATE 抢占，多个 worker 同时认领同一任务时只有一个能更新成功，
+    其余的换下一个候选重试。
+    向同一历史记录追加文件的任务依次执行：后一个任务要与前一个加入的文件配对，
+    因此同一 history_id 已有任务在执行时，排队中的同类任务暂不认领。
+    """
+    running = aliased(Job)
+    history_free = ~exists().where(running.history_id == Job.history_id, running.status == JOB_PROCESSING)
+    while True:
+        job_id = db.query(Job.id).filter(Job.status == JOB_QUEUED, history_free).order_by(
+            Job.priority.desc(), Job.id).limit(1).scalar()
+        if job_id is None:
+            return None
+        now = _now()
+        claimed = db.execute(_update_jobs(Job.id == job_id, Job.status == JOB_QUEUED, history_free).values(
+            status=JOB_PROCESSING, worker_id=worker_id, attempts=Job.attempts + 1,
+            started_at=now, heartbeat_at=now)).rowcount
+        db.commit()
+        if claimed:
+            return db.query(Job).filter(Job.id == job_id).one()
+
+
+def _owned_by(task_id: str, worker_id: str):
+    # 任务心跳超时被重新排队后可能已由其他 worker 认领，原 worker 的写回不能覆盖新的状态
+    return Job.task_id == task_id, Job.worker_id == worker_id, Job.status == JOB_PROCESSING
+
+
+def heartbeat_job(db: Session, task_id: str, worker_id: str, pairs_done: Optional[int] = None,
+                  pairs_total: Optional[int] = None, partial_results: Optional[List[Dict]] = None) -> bool:
+    """刷新心跳时间，并写入 worker 内存中的最新进度。任务已不属于该 worker 时什么也不做并返回 False。"""
+    values: Dict[str, Any] = {"heartbeat_at": _now(), "pairs_done": pairs_done, "pairs_total": pairs_total}
+    if partial_results is not None:
+        values["partial_results"] = json.dumps(partial_results)
+    updated = db.execute(_update_jobs(*_owned_by(task_id, worker_id)).values(**values)).rowcount
+    db.commit()
+    return bool(updated)
+
+
+def finish_job(db: Session, task_id: str, worker_id: str, features: Optional[bytes] = None) -> bool:
+    updated = db.execute(_update_jobs(*_owned_by(task_id, worker_id)).values(
+        status=JOB_COMPLETED, finished_at=_now(), partial_results=None, features=features)).rowcount
+    db.commit()
+    return bool(updated)
+
+
+def fail_job(db: Session, task_id: str, worker_id: str, error: str) -> bool:
+    updated = db.execute(_update_jobs(*_owned_by(task_id, worker_id)).values(
+        status=JOB_ERROR, finished_at=_now(), partial_results=None, error=error)).rowcount
+    db.commit()
+    return bool(updated)
+
+
+def requeue_stale_jobs(db: Session, stale_seconds: float = JOB_STALE_SECONDS,
+                       max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+    """把心跳超时的任务放回队列；已经尝试 max_attempts 次的任务标记为失败。返回重新排队的任务数。"""
+    cutoff = _now() - datetime.timedelta(seconds=stale_seconds)
+    stale = (Job.status == JOB_PROCESSING) & (Job.heartbeat_at < cutoff)
+    db.execute(_update_jobs(stale, Job.attempts >= max_attempts).values(
+        status=JOB_ERROR, finished_at=_now(), partial_results=None,
+        error="The worker running this check stopped responding too many times."))
+    requeued = db.execute(_update_jobs(stale).values(
+        status=JOB_QUEUED, worker_id=None, pairs_done=None, partial_results=None)).rowcount
+    db.commit()
+    return requeued
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, Float, Boolean, func
+from sqlalchemy import Column, Integer, String, Text, DateTime, Float, Boolean, LargeBinary, Index, func
 from sqlalchemy.orm import declarative_base
 import datetime
 
@@ -13,11 +13,27 @@ class CodeSubmission(Base):
     content = Column(Text)
     submitted_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
     content_hash = Column(String(64), unique=True, index=True)
+    fingerprint = Column(LargeBinary, nullable=True)  # 压缩后的 token 流与指纹，格式见 core.CodeFingerprint.to_blob
+    indexed = Column(Boolean, default=False, nullable=False, server_default="0")  # 指纹是否已写入倒排索引
+
+
+class FingerprintPosting(Base):
+    """倒排索引：winnowing 指纹哈希 -> 含有该指纹的 CodeSubmission。按 (hash, submission_id) 聚簇存放，
+    一次查询只需在主键 B 树上做范围扫描。"""
+    __tablename__ = "fingerprint_postings"
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    hash = Column(Integer, primary_key=True, autoincrement=False)  # 61 位 Karp-Rabin 哈希，放得进 SQLite INTEGER
+    submission_id = Column(Integer, primary_key=True, autoincrement=False)
 
 
 class QueryHistory(Base):
     """用于存储每一次查询任务的元数据"""
     __tablename__ = "query_history"
+    __table_args__ = (
+        # 同一任务重新执行时凭 task_id 找回并复用已创建的记录，见 submissions.save_task_history
+        Index('ix_query_history_task_id', 'task_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     query_time = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
@@ -25,11 +41,32 @@ class QueryHistory(Base):
     folder_name = Column(String, nullable=True)
     special_file_name = Column(String, nullable=True)
     description = Column(Text)
+    algorithm = Column(String(20), nullable=False, default='sequence', server_default='sequence')
+    window_size = Column(Integer, nullable=False, default=4, server_default='4')
+    task_id = Column(String(36), nullable=True)  # 创建该记录的任务，旧版本留下的记录为空
+
+
+class HistoryFile(Base):
+    """记录某次历史任务包含的文件，文件内容通过 content_hash 存放在 CodeSubmission 中"""
+    __tablename__ = "history_files"
+
+    id = Column(Integer, primary_key=True, index=True)
+    history_id = Column(Integer, index=True)
+    filename = Column(String)
+    content_hash = Column(String(64))
+    is_base = Column(Boolean, default=False, nullable=False)  # 一对多比对中的基准文件
+    task_id = Column(String(36), nullable=True)  # 加入该文件的任务，追加文件的任务重新执行时据此清理上次的写入
 
 
 class HistoryResult(Base):
     """用于存储某次历史任务下的具体比对结果"""
     __tablename__ = "history_results"
+    __table_args__ = (
+        # GET /history/{id} 按相似度降序列出一次任务的结果，可直接沿索引顺序读取而无需排序
+        Index('ix_history_results_history_similarity', 'history_id', 'similarity'),
+        # /export/plagiarized 只取被标记的少量行
+        Index('ix_history_results_plagiarized', 'plagiarized'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     history_id = Column(Integer, index=True)
@@ -38,9 +75,51 @@ class HistoryResult(Base):
     file2 = Column(String)
     similarity = Column(Float)
     plagiarized = Column(Boolean, default=False, nullable=False)
+    bounded = Column(Boolean, default=False, nullable=False, server_default="0")
 
 
 class Setting(Base):
     __tablename__ = 'settings'
     key = Column(String, primary_key=True)
     value = Column(String)
+
+
+class TaskRecord(Base):
+    """已完成任务的落盘记录：任务被移出内存（或服务器重启）后，凭 task_id 找回对应的历史记录"""
+    __tablename__ = "task_records"
+
+    task_id = Column(String(36), primary_key=True)
+    history_id = Column(Integer, index=True)
+    skipped_pairs = Column(Integer, nullable=True)
+    pairs_total = Column(Integer, nullable=True)
+    completed_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+
+
+class Job(Base):
+    """持久化的查重任务队列。API 只负责入队，独立的 worker 进程认领、执行并写回结果，见 app/jobs.py"""
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # worker 认领时按 (优先级降序, 入队顺序) 取第一条排队中的任务
+        Index('ix_jobs_claim', 'status', 'priority', 'id'),
+        # 认领追加文件的任务前，检查同一历史记录是否已有任务在执行
+        Index('ix_jobs_history', 'history_id', 'status'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String(36), unique=True, nullable=False)
+    kind = Column(String(20), nullable=False)  # folder / one_to_many / incremental
+    priority = Column(Integer, nullable=False, default=0, server_default='0')  # 越大越先执行
+    status = Column(String(20), nullable=False, default='queued', server_default='queued')  # queued / processing / completed / error
+    payload = Column(Text, nullable=False)  # JSON：文件名 -> 内容哈希、算法参数等，文件内容在 CodeSubmission 中
+    history_id = Column(Integer, nullable=True)  # 追加文件的任务所修改的历史记录，其他任务为空
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    worker_id = Column(String, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.timezone.utc))
+    started_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    pairs_done = Column(Integer, nullable=True)
+    pairs_total = Column(Integer, nullable=True)
+    partial_results = Column(Text, nullable=True)  # JSON，进行中得分最高的若干结果，随心跳更新
+    features = Column(LargeBinary, nullable=True)  # 文件夹互查的特征矩阵（npy 格式），用于下载近似相似度矩阵
+    error = Column(Text, nullable=True)
@@ -11,6 +11,7 @@ class ComparisonResultItem(BaseModel):
     similarity: float = Field(..., description="相似度得分 (0.0 to 1.0)")
     # 【新增】抄袭标记字段
     plagiarized: bool = Field(False, description="是否被标记为抄袭")
+    bounded: bool = Field(False, description="为 True 时 similarity 只是上界，真实得分低于该值")
 
     class Config:
         from_attributes = True
@@ -19,8 +20,15 @@ class ComparisonResultItem(BaseModel):
 class TaskStatusResponse(BaseModel):
     """任务状态响应模型"""
     task_id: str
-    status: str = Field(..., description="任务状态: processing, completed, or error")
+    status: str = Field(..., description="任务状态: queued, processing, completed, or error")
     results: Optional[List[ComparisonResultItem]] = None  # 仅在 completed 时提供
+    skipped_pairs: Optional[int] = Field(None, description="被特征预筛选或 LSH 候选剪枝跳过、未精确打分的文件对数量")
+    pairs_done: Optional[int] = Field(None, description="已完成打分的文件对数量")
+    pairs_total: Optional[int] = Field(None, description="需要打分的文件对总数，开始打分前为空")
+    partial_results: Optional[List[ComparisonResultItem]] = Field(
+        None, description="任务进行中目前得分最高的若干结果，按相似度降序")
+    next_cursor: Optional[str] = Field(None, description="分页查询历史结果时下一页的游标，没有更多结果时为空")
+    error: Optional[str] = Field(None, description="任务失败时的错误信息")
 
 
 class CodeLine(BaseModel):
@@ -63,3 +71,51 @@ class MarkPlagiarizedRequest(BaseModel):
 class SimilarityThreshold(BaseModel):
     """相似度阈值的模型"""
     threshold: float
+
+
+class WorkerCount(BaseModel):
+    """配对打分进程数的模型"""
+    workers: int = Field(..., ge=1, description="并行打分的进程数，1 表示串行")
+
+
+class ReportFloor(BaseModel):
+    """报告下限的模型"""
+    floor: float = Field(..., ge=0.0, le=1.0, description="得分上界低于该值的配对不做精确打分，0 表示关闭")
+
+
+class FeaturePrefilter(BaseModel):
+    """特征向量预筛选的模型"""
+    cutoff: float = Field(..., ge=0.0, le=1.0, description="特征余弦相似度低于该值的文件对不做精确打分，0 表示关闭")
+
+
+class LshJaccard(BaseModel):
+    """LSH 候选剪枝阈值的模型"""
+    jaccard: float = Field(..., ge=0.0, le=1.0,
+                           description="非 winnowing 算法按该指纹 Jaccard 阈值做 LSH 剪枝，0 表示关闭")
+
+
+class HashNegotiationRequest(BaseModel):
+    """上传协商的请求体：待提交文件内容的 SHA-256 列表"""
+    hashes: List[str] = Field(..., max_length=5000, description="每个文件 UTF-8 内容的 SHA-256 十六进制摘要")
+
+
+class HashNegotiationResponse(BaseModel):
+    """上传协商的响应：服务器尚未保存、需要实际上传内容的哈希"""
+    missing: List[str]
+
+
+class ArchiveMatch(BaseModel):
+    """归档检索命中的一份历史提交"""
+    submission_id: int
+    filename: str
+    submitted_at: Optional[datetime.datetime] = None
+    similarity: float = Field(..., description="相似度得分 (0.0 to 1.0)")
+    shared_fingerprints: int = Field(..., description="与查询代码共享的 winnowing 指纹数")
+    bounded: bool = Field(False, description="为 True 时 similarity 只是上界，真实得分低于该值")
+
+
+class ArchiveSearchResponse(BaseModel):
+    """归档检索的响应模型"""
+    filename: str
+    candidates: int = Field(..., description="经倒排索引筛选后做了精确打分的候选数")
+    results: List[ArchiveMatch]
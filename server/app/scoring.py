@@ -0,0 +1,83 @@
+import math
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from .core import CodeFingerprint, ScoringOptions, PairScore, score_fingerprints, batch_fallback_similarities
+
+MIN_PARALLEL_PAIRS = 500  # 配对数少于该值时进程池的启动开销得不偿失
+CHUNKS_PER_WORKER = 4
+PROGRESS_INTERVAL = 256  # 串行打分时每完成这么多对汇报一次进度
+
+# (结果序号, 文件1的键, 文件2的键)
+Pair = Tuple[int, Hashable, Hashable]
+# 进度回调，参数为刚完成的一批 (结果序号, 得分)
+ProgressCallback = Callable[[List[Tuple[int, PairScore]]], None]
+
+# 子进程内的全局状态，由 _init_worker 在进程启动时设置一次
+_worker_fingerprints: Dict[Hashable, CodeFingerprint] = {}
+_worker_options: Optional[ScoringOptions] = None
+
+
+def _init_worker(fingerprints: Dict[Hashable, CodeFingerprint], options: ScoringOptions):
+    global _worker_fingerprints, _worker_options
+    _worker_fingerprints = fingerprints
+    _worker_options = options
+
+
+def _score_chunk(chunk: List[Pair]) -> List[Tuple[int, PairScore]]:
+    return [(i, score_fingerprints(_worker_fingerprints[key1], _worker_fingerprints[key2], _worker_options))
+            for i, key1, key2 in chunk]
+
+
+def _chunked(pairs: List[Pair], workers: int) -> List[List[Pair]]:
+    size = max(1, math.ceil(len(pairs) / (workers * CHUNKS_PER_WORKER)))
+    return [pairs[start:start + size] for start in range(0, len(pairs), size)]
+
+
+def score_pairs(fingerprints: Dict[Hashable, CodeFingerprint], pairs: List[Pair], options: ScoringOptions,
+                workers: int = 1, progress: Optional[ProgressCallback] = None) -> Dict[int, PairScore]:
+    """为一组配对打分，返回 {结果序号: PairScore}。
+
+    解析失败的配对在主进程中批量走 TF-IDF 回退；其余配对在 workers > 1 时切分成若干块，
+    交给进程池并行计算。指纹在每个子进程启动时只传输一次，而不是随每个配对传输。
+    给出 progress 时，每完成一批配对就用这一批的得分调用一次，调用总在当前线程中进行。
+    """
+    report = progress or (lambda batch: None)
+    fallback_pairs = [(key1, key2) for _, key1, key2 in pairs
+                      if not (fingerprints[key1].parsed and fingerprints[key2].parsed)]
+    fallback_scores = batch_fallback_similarities(fingerprints, fallback_pairs)
+
+    scores: Dict[int, PairScore] = {}
+    structural = []
+    for i, key1, key2 in pairs:
+        if (key1, key2) in fallback_scores:
+            scores[i] = PairScore(fallback_scores[(key1, key2)])
+        else:
+            structural.append((i, key1, key2))
+    if scores:
+        report(list(scores.items()))
+
+    if workers <= 1 or len(structural) < MIN_PARALLEL_PAIRS:
+        batch = []
+        for i, key1, key2 in structural:
+            scores[i] = score_fingerprints(fingerprints[key1], fingerprints[key2], options)
+            batch.append((i, scores[i]))
+            if len(batch) >= PROGRESS_INTERVAL:
+                report(batch)
+                batch = []
+        if batch:
+            report(batch)
+        return scores
+
+    needed = {key for _, key1, key2 in structural for key in (key1, key2)}
+    shipped = {key: fingerprints[key] for key in needed}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(shipped, options)) as executor:
+        futures = [executor.submit(_score_chunk, chunk) for chunk in _chunked(structural, workers)]
+        # 结果按完成顺序流式合并；按序号存放，因此与串行执行的结果完全一致
+        for future in as_completed(futures):
+            batch = future.result()
+            for i, score in batch:
+                scores[i] = score
+            report(batch)
+    return scores
@@ -0,0 +1,311 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import insert, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .core import (
+    CodeFingerprint, FingerprintCache, build_fingerprint, content_hash, BLOB_VERSION, WINNOW_K, WINNOW_WINDOW
+)
+from .models import CodeSubmission, FingerprintPosting, HistoryFile, HistoryResult, QueryHistory, Setting
+
+# 旧版 SQLite 单条语句最多 999 个绑定参数，IN 查询和批量插入按块进行
+SQL_CHUNK_SIZE = 200
+# executemany 每行单独绑定参数，不受上面的限制；分块只是为了不一次性构造全部参数字典
+BULK_INSERT_CHUNK_SIZE = 5000
+
+
+def sql_chunks(items: List, size: int = SQL_CHUNK_SIZE) -> Iterable[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_fingerprints(db: Session, files_content: Dict[str, str],
+                      cache: FingerprintCache) -> Dict[str, CodeFingerprint]:
+    """为一批文件取得指纹：先查内存缓存，再查 CodeSubmission 中保存的指纹块，都没有才解析。
+
+    新文件（包括只在内存缓存中出现过的文件，以及旧版本留下的、没有指纹块的记录）会写回 CodeSubmission，
+    之后重复提交的文件或跨作业共用的起始代码都不必再次解析和规范化。
+    """
+    by_hash: Dict[str, CodeFingerprint] = {}
+    hashes = {name: content_hash(code) for name, code in files_content.items()}
+    code_of = {hashes[name]: code for name, code in files_content.items()}
+
+    missing = []
+    for key in code_of:
+        fingerprint = cache.lookup(key)
+        if fingerprint is not None:
+            by_hash[key] = fingerprint
+        else:
+            missing.append(key)
+
+    # 缓存命中的文件可能来自不落库的直接比对或检索，或者只由 store_contents 存了内容，同样需要补上记录和指纹块
+    new_rows = []
+    for chunk in sql_chunks(list(by_hash)):
+        has_blob = dict(db.query(CodeSubmission.content_hash, CodeSubmission.fingerprint.isnot(None)).filter(
+            CodeSubmission.content_hash.in_(chunk)).all())
+        for key in chunk:
+            if key not in has_blob:
+                new_rows.append(by_hash[key])
+            elif not has_blob[key]:
+                db.query(CodeSubmission).filter(CodeSubmission.content_hash == key).update(
+                    {CodeSubmission.fingerprint: by_hash[key].to_blob()})
+
+    stale = set()
+    for chunk in sql_chunks(missing):
+        rows = db.query(CodeSubmission.content_hash, CodeSubmission.fingerprint).filter(
+            CodeSubmission.content_hash.in_(chunk)).all()
+        for key, blob in rows:
+            fingerprint = CodeFingerprint.from_blob(blob, code_of[key], key) if blob else None
+            if fingerprint is None:
+                stale.add(key)
+                continue
+            by_hash[key] = fingerprint
+            cache.put(fingerprint)
+
+    for key in missing:
+        if key in by_hash:
+            continue
+        fingerprint = build_fingerprint(code_of[key], key)
+        by_hash[key] = fingerprint
+        cache.put(fingerprint)
+        if key in stale:
+            db.query(CodeSubmission).filter(CodeSubmission.content_hash == key).update(
+                {CodeSubmission.fingerprint: fingerprint.to_blob()})
+        else:
+            new_rows.append(fingerprint)
+
+    filename_of = {hashes[name]: name for name in reversed(list(files_content))}
+    for chunk in sql_chunks(new_rows):
+        # 并发任务可能同时提交同一份文件，content_hash 冲突时保留已有记录
+        db.execute(sqlite_insert(CodeSubmission).values([
+            {"filename": filename_of[fp.content_hash], "content": fp.code,
+             "content_hash": fp.content_hash, "fingerprint": fp.to_blob()}
+            for fp in chunk
+        ]).on_conflict_do_nothing(index_elements=['content_hash']))
+    index_submissions(db, by_hash)
+    db.commit()
+
+    return {name: by_hash[hashes[name]] for name in files_content}
+
+
+def index_submissions(db: Session, by_hash: Dict[str, CodeFingerprint]):
+    """把尚未入索引的提交的 winnowing 指纹写入倒排索引。索引固定使用默认的 k 与窗口，与任务选择的参数无关。"""
+    for chunk in sql_chunks(list(by_hash)):
+        rows = db.query(CodeSubmission.id, CodeSubmission.content_hash).filter(
+            CodeSubmission.content_hash.in_(chunk), CodeSubmission.indexed == False).all()
+        if not rows:
+            continue
+        postings = [{"hash": h, "submission_id": submission_id}
+                    for submission_id, key in rows
+                    for h in by_hash[key].winnowed(WINNOW_K, WINNOW_WINDOW)]
+        if postings:
+            db.execute(sqlite_insert(FingerprintPosting).on_conflict_do_nothing(), postings)
+        db.query(CodeSubmission).filter(CodeSubmission.id.in_([submission_id for submission_id, _ in rows])).update(
+            {CodeSubmission.indexed: True}, synchronize_session=False)
+
+
+def reset_stale_index(db: Session) -> bool:
+    """倒排索引由指纹生成，指纹格式（BLOB_VERSION）变化后旧索引中的哈希全部失效。
+
+    此时清空索引并把所有提交标记为未入索引，由 backfill_index 按新格式重建。返回是否做了重置。
+    """
+    setting = db.query(Setting).filter(Setting.key == "index_version").first()
+    if setting is not None and setting.value == str(BLOB_VERSION):
+        return False
+    if setting is None:
+        setting = Setting(key="index_version")
+        db.add(setting)
+    db.query(FingerprintPosting).delete(synchronize_session=False)
+    db.query(CodeSubmission).update({CodeSubmission.indexed: False}, synchronize_session=False)
+    setting.value = str(BLOB_VERSION)
+    db.commit()
+    return True
+
+
+def backfill_index(db: Session, batch_size: int = SQL_CHUNK_SIZE) -> int:
+    """把尚未入索引的提交（indexed 为 False，例如倒排索引上线之前保存的提交）分批写入索引，每批单独提交。
+    返回处理的记录数。
+
+    没有指纹块或指纹块版本过期的记录顺便重新生成指纹块。可以重复执行，已入索引的记录不会再处理。
+    """
+    done, last_id = 0, 0
+    while True:
+        rows = db.query(CodeSubmission.id, CodeSubmission.content_hash, CodeSubmission.content,
+                        CodeSubmission.fingerprint).filter(
+            CodeSubmission.indexed == False, CodeSubmission.id > last_id).order_by(
+            CodeSubmission.id).limit(batch_size).all()
+        if not rows:
+            return done
+        by_hash: Dict[str, CodeFingerprint] = {}
+        for submission_id, key, code, blob in rows:
+            fingerprint = CodeFingerprint.from_blob(blob, code, key) if blob else None
+            if fingerprint is None:
+                fingerprint = build_fingerprint(code, key)
+                db.query(CodeSubmission).filter(CodeSubmission.id == submission_id).update(
+                    {CodeSubmission.fingerprint: fingerprint.to_blob()}, synchronize_session=False)
+            by_hash[key] = fingerprint
+        index_submissions(db, by_hash)
+        db.commit()
+        done += len(rows)
+        last_id = rows[-1][0]
+
+
+def store_contents(db: Session, files_content: Dict[str, str]) -> Dict[str, str]:
+    """把文件内容按哈希存入 CodeSubmission（不计算指纹），返回 {文件名: 内容哈希}。调用方负责提交事务。
+
+    入队的任务只保存哈希，worker 执行时再按哈希取回内容；指纹由 load_fingerprints 在执行时补上。
+    """
+    hashes = {name: content_hash(code) for name, code in files_content.items()}
+    rows = list({hashes[name]: {"filename": name, "content": code, "content_hash": hashes[name]}
+                 for name, code in files_content.items()}.values())
+    for chunk in sql_chunks(rows):
+        db.execute(sqlite_insert(CodeSubmission).values(chunk).on_conflict_do_nothing(
+            index_elements=['content_hash']))
+    return hashes
+
+
+def store_fingerprints(db: Session, files: Iterable[Tuple[str, str]],
+                       batch_size: int = SQL_CHUNK_SIZE) -> Dict[str, str]:
+    """边读边存：逐个计算内容哈希，每攒够 batch_size 个文件就为库中还没有的内容生成指纹，连同指纹块写入
+    CodeSubmission。返回 {文件名: 内容哈希}，调用方负责提交事务。
+
+    files 可以是生成器，内存中只保留文件名到哈希的映射和当前一批文件，适合压缩包这类总量很大的输入；
+    worker 执行时直接使用这里存下的指纹块，不必再解析。
+    """
+    hashes: Dict[str, str] = {}
+    batch: Dict[str, Tuple[str, str]] = {}
+
+    def flush():
+        rows = []
+        for key in missing_hashes(db, list(batch)):
+            filename, code = batch[key]
+            rows.append({"filename": filename, "content": code, "content_hash": key,
+                         "fingerprint": build_fingerprint(code, key).to_blob()})
+        if rows:
+            db.execute(sqlite_insert(CodeSubmission).values(rows).on_conflict_do_nothing(
+                index_elements=['content_hash']))
+        batch.clear()
+
+    for filename, code in files:
+        key = content_hash(code)
+        hashes[filename] = key
+        batch.setdefault(key, (filename, code))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return hashes
+
+
+def missing_hashes(db: Session, hashes: List[str]) -> List[str]:
+    """返回 hashes 中 CodeSubmission 尚未保存的那些，保持原顺序并去重。"""
+    wanted = list(dict.fromkeys(hashes))
+    known = set()
+    for chunk in sql_chunks(wanted):
+        known.update(key for key, in db.query(CodeSubmission.content_hash).filter(
+            CodeSubmission.content_hash.in_(chunk)))
+    return [key for key in wanted if key not in known]
+
+
+def load_contents_by_hash(db: Session, hashes: List[str]) -> Dict[str, str]:
+    """按内容哈希取回已保存的代码 {哈希: 代码}，不存在的哈希不出现在结果中。"""
+    contents = {}
+    for chunk in sql_chunks(list(set(hashes))):
+        contents.update(db.query(CodeSubmission.content_hash, CodeSubmission.content).filter(
+            CodeSubmission.content_hash.in_(chunk)).all())
+    return contents
+
+
+def save_task_history(db: Session, task_id: str, **fields) -> int:
+    """为任务创建 QueryHistory（不提交），返回其 id。
+
+    worker 心跳超时后任务会重新排队，原 worker 可能仍在运行，同一任务因此可能执行两次。
+    再次执行时复用上次创建的记录并删除上次写入的文件和结果，与随后写入的新内容在同一事务中提交。
+    """
+    history = db.query(QueryHistory).filter(QueryHistory.task_id == task_id).first()
+    if history is None:
+        history = QueryHistory(task_id=task_id, **fields)
+        db.add(history)
+        db.flush()
+        return history.id
+    for key, value in fields.items():
+        setattr(history, key, value)
+    db.query(HistoryFile).filter(HistoryFile.history_id == history.id).delete(synchronize_session=False)
+    db.query(HistoryResult).filter(HistoryResult.history_id == history.id).delete(synchronize_session=False)
+    return history.id
+
+
+def discard_task_writes(db: Session, history_id: int, task_id: str):
+    """删除某个任务上次执行时向已有历史记录追加的文件和结果（不提交），用于追加文件的任务重新执行。"""
+    db.query(HistoryFile).filter(HistoryFile.history_id == history_id, HistoryFile.task_id == task_id).delete(
+        synchronize_session=False)
+    # result_id 的格式为 "{task_id}-{序号}"
+    db.query(HistoryResult).filter(HistoryResult.history_id == history_id,
+                                   HistoryResult.result_id.startswith(f"{task_id}-")).delete(
+        synchronize_session=False)
+
+
+def record_history_files(db: Session, history_id: int, task_id: str, files_content: Dict[str, str],
+                         base_filename: Optional[str] = None, base_content: Optional[str] = None):
+    """记录一次历史任务包含哪些文件，供之后追加文件时取回已有文件的内容。调用方负责提交事务。"""
+    rows = [{"history_id": history_id, "filename": name, "content_hash": content_hash(code), "is_base": False,
+             "task_id": task_id}
+            for name, code in files_content.items()]
+    if base_filename is not None:
+        rows.append({"history_id": history_id, "filename": base_filename,
+                     "content_hash": content_hash(base_content), "is_base": True, "task_id": task_id})
+    for chunk in sql_chunks(rows, BULK_INSERT_CHUNK_SIZE):
+        db.execute(insert(HistoryFile), chunk)
+
+
+def save_history_results(db: Session, history_id: int, results_list: List):
+    """在一个事务中批量写入一次任务的比对结果。
+
+    用 Core insert() 的 executemany 代替逐条 db.add(HistoryResult(...))，
+    省去 ORM 对象构造和 unit-of-work 的逐行开销。
+    """
+    for chunk in sql_chunks(results_list, BULK_INSERT_CHUNK_SIZE):
+        db.execute(insert(HistoryResult), [
+            {"history_id": history_id, "result_id": res.result_id, "file1": res.file1, "file2": res.file2,
+             "similarity": res.similarity, "plagiarized": res.plagiarized, "bounded": res.bounded}
+            for res in chunk
+        ])
+    db.commit()
+
+
+def _history_file_criteria(history_id: int, exclude_task_id: Optional[str]) -> List:
+    criteria = [HistoryFile.history_id == history_id, HistoryFile.is_base == False]
+    if exclude_task_id is not None:
+        # 旧版本留下的文件 task_id 为空，!= 对 NULL 不成立，需要单独保留
+        criteria.append(or_(HistoryFile.task_id.is_(None), HistoryFile.task_id != exclude_task_id))
+    return criteria
+
+
+def load_history_files(db: Session, history_id: int, exclude_task_id: Optional[str] = None) -> Dict[str, str]:
+    """取回一次文件夹互查任务的全部文件内容 {文件名: 代码}，exclude_task_id 加入的文件除外。"""
+    rows = db.query(HistoryFile.filename, CodeSubmission.content).join(
+        CodeSubmission, CodeSubmission.content_hash == HistoryFile.content_hash
+    ).filter(*_history_file_criteria(history_id, exclude_task_id)).all()
+    return {filename: content for filename, content in rows}
+
+
+def load_history_filenames(db: Session, history_id: int, exclude_task_id: Optional[str] = None) -> Set[str]:
+    """同 load_history_files，但只取文件名。"""
+    return {filename for filename, in db.query(HistoryFile.filename).filter(
+        *_history_file_criteria(history_id, exclude_task_id))}
+
+
+def load_history_file_contents(db: Session, history_id: int, filenames: List[str]
+                               ) -> Tuple[Dict[str, str], Optional[Tuple[str, str]]]:
+    """取回一次历史任务中指定文件的内容，返回 ({文件名: 代码}, (基准文件名, 代码) 或 None)。"""
+    rows = db.query(HistoryFile.filename, HistoryFile.is_base, CodeSubmission.content).join(
+        CodeSubmission, CodeSubmission.content_hash == HistoryFile.content_hash
+    ).filter(HistoryFile.history_id == history_id, HistoryFile.filename.in_(filenames)).all()
+    files, base_file = {}, None
+    for filename, is_base, content in rows:
+        if is_base:
+            base_file = (filename, content)
+        else:
+            files[filename] = content
+    return files, base_file
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from .models import TaskRecord
+
+# 可通过环境变量调整；只有已完成的任务会被移出内存，进行中的任务始终保留
+TASK_TTL_SECONDS = int(os.environ.get("SONAR_TASK_TTL_SECONDS", "3600"))  # 距上次访问超过该时长即移出
+TASK_MAX_ENTRIES = int(os.environ.get("SONAR_TASK_MAX_ENTRIES", "200"))
+TASK_MAX_MEMORY_MB = int(os.environ.get("SONAR_TASK_MAX_MEMORY_MB", "512"))
+
+# 估算任务占用内存时每条结果、每个配对映射的大致字节数
+_RESULT_BYTES = 400
+_PAIR_BYTES = 200
+
+
+def estimate_task_size(task: Dict) -> int:
+    """粗略估算一个任务在内存中占用的字节数：文件内容为主，加上结果与配对映射。"""
+    size = sum(len(code) for code in (task.get('files') or {}).values())
+    if task.get('base_file'):
+        size += len(task['base_file'][1])
+    size += len(task.get('summary_results') or ()) * _RESULT_BYTES
+    size += len(task.get('pairs') or ()) * _PAIR_BYTES
+    features = task.get('features')
+    if features is not None:
+        size += features[1].nbytes
+    return size
+
+
+class TaskStore:
+    """有容量上限和 TTL 的任务表，用法与原先的 tasks_db 字典相同。
+
+    任务完成时在 TaskRecord 中落盘 task_id -> history_id，结果本身已经在 HistoryResult 里，
+    文件内容在 HistoryFile/CodeSubmission 里，因此任务被移出内存后仍可从数据库还原。
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], ttl: float = TASK_TTL_SECONDS,
+                 max_entries: int = TASK_MAX_ENTRIES, max_bytes: int = TASK_MAX_MEMORY_MB * 1024 * 1024):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._tasks: "OrderedDict[str, Dict]" = OrderedDict()
+        self._last_access: Dict[str, float] = {}
+        self._sizes: Dict[str, int] = {}  # 只记录已完成任务
+        self._lock = threading.Lock()
+
+    def __setitem__(self, task_id: str, task: Dict):
+        with self._lock:
+            self._tasks[task_id] = task
+            self._last_access[task_id] = time.monotonic()
+            self._evict()
+
+    def __getitem__(self, task_id: str) -> Dict:
+        task = self.get(task_id)
+        if task is None:
+            raise KeyError(task_id)
+        return task
+
+    def __contains__(self, task_id: str) -> bool:
+        return self.get(task_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        """返回内存中的任务；不在内存中（从未存在、已过期或已移出）时返回 None。"""
+        with self._lock:
+            self._evict()
+            task = self._tasks.get(task_id)
+            if task is not None:
+                self._tasks.move_to_end(task_id)
+                self._last_access[task_id] = time.monotonic()
+            return task
+
+    def complete(self, task_id: str, history_id: int, **fields):
+        """把任务标记为完成并落盘，fields 会并入任务字典（如 summary_results、skipped_pairs）。"""
+        db = self.session_factory()
+        try:
+            task = self._tasks[task_id]
+            db.merge(TaskRecord(task_id=task_id, history_id=history_id, skipped_pairs=fields.get('skipped_pairs'),
+                                pairs_total=task.get('pairs_total')))
+            db.commit()
+        finally:
+            db.close()
+        with self._lock:
+            task.update(fields, status='completed', partial_results=None, history_id=history_id)
+            self._sizes[task_id] = estimate_task_size(task)
+            self._evict()
+
+    def discard(self, task_id: str):
+        """立即移出一个任务，任务不存在时什么也不做。"""
+        with self._lock:
+            self._drop(task_id)
+
+    def _drop(self, task_id: str):
+        self._tasks.pop(task_id, None)
+        self._last_access.pop(task_id, None)
+        self._sizes.pop(task_id, None)
+
+    def _evict(self):
+        # 调用方持有锁。按最近访问顺序，从最久未访问的已完成任务开始移出
+        now = time.monotonic()
+        for task_id in [tid for tid in self._sizes if now - self._last_access[tid] > self.ttl]:
+            self._drop(task_id)
+        completed = [tid for tid in self._tasks if tid in self._sizes]
+        total = sum(self._sizes.values())
+        for task_id in completed:
+            if len(self._tasks) <= self.max_entries and total <= self.max_bytes:
+                break
+            total -= self._sizes[task_id]
+            self._drop(task_id)
@@ -0,0 +1,82 @@
+import posixpath
+import tarfile
+import zipfile
+from typing import BinaryIO, Iterator, Set, Tuple
+
+MAX_ARCHIVE_FILES = 5000  # 单个压缩包最多包含的 .py 文件数
+MAX_ARCHIVE_MEMBER_BYTES = 2 * 1024 * 1024  # 单个 .py 文件解压后的大小上限，防止压缩炸弹
+MAX_ARCHIVE_TOTAL_BYTES = 200 * 1024 * 1024  # 所有 .py 文件解压后的总大小上限
+
+_ZIP_MAGIC = b'PK\x03\x04'
+_GZIP_MAGIC = b'\x1f\x8b'
+# 截断或损坏的压缩包在读取目录或成员内容时抛出的异常
+_CORRUPT_ERRORS = (tarfile.TarError, zipfile.BadZipFile, EOFError, OSError)
+
+
+class ArchiveError(ValueError):
+    """压缩包格式不支持或内容不合法，message 可直接返回给客户端。"""
+
+
+def _iter_tar(fileobj: BinaryIO) -> Iterator[Tuple[str, BinaryIO, int]]:
+    # r|gz 是纯顺序读取的流模式，不需要先把整个压缩包解压或载入内存
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member), member.size
+
+
+def _iter_zip(fileobj: BinaryIO) -> Iterator[Tuple[str, BinaryIO, int]]:
+    with zipfile.ZipFile(fileobj) as zf:
+        for info in zf.infolist():
+            if not info.is_dir():
+                with zf.open(info) as member:
+                    yield info.filename, member, info.file_size
+
+
+def iter_archive_members(fileobj: BinaryIO) -> Iterator[Tuple[str, BinaryIO, int]]:
+    """按魔数识别 zip / tar.gz，逐个产出 (成员路径, 可读流, 声明的大小)。"""
+    magic = fileobj.read(4)
+    fileobj.seek(0)
+    try:
+        if magic.startswith(_ZIP_MAGIC):
+            yield from _iter_zip(fileobj)
+        elif magic.startswith(_GZIP_MAGIC):
+            yield from _iter_tar(fileobj)
+        else:
+            raise ArchiveError("Unsupported archive format. Upload a .zip or .tar.gz file.")
+    except _CORRUPT_ERRORS as e:
+        raise ArchiveError(f"Corrupt archive: {e}")
+
+
+def iter_python_files(fileobj: BinaryIO) -> Iterator[Tuple[str, str]]:
+    """边解压边逐个产出压缩包中的 .py 文件 (文件名, 代码)，同一时刻只有一个成员在内存中。
+
+    文件以不含目录的文件名为键，与逐个上传时一致；其他类型的文件和 macOS 的 __MACOSX 元数据被忽略。
+    重名、数量、大小和编码检查在读到对应成员时进行，不合法时抛出 ArchiveError。
+    """
+    seen: Set[str] = set()
+    total_bytes = 0
+    for path, member, size in iter_archive_members(fileobj):
+        filename = posixpath.basename(path)
+        if not filename.endswith('.py') or path.startswith('__MACOSX/') or filename.startswith('._'):
+            continue
+        if filename in seen:
+            raise ArchiveError(f"Duplicate filename '{filename}' in archive. Please provide files with unique names.")
+        if len(seen) >= MAX_ARCHIVE_FILES:
+            raise ArchiveError(f"Archive contains more than {MAX_ARCHIVE_FILES} Python files.")
+        seen.add(filename)
+        try:
+            data = member.read(MAX_ARCHIVE_MEMBER_BYTES + 1)
+        except _CORRUPT_ERRORS as e:
+            raise ArchiveError(f"Corrupt archive: {e}")
+        if size > MAX_ARCHIVE_MEMBER_BYTES or len(data) > MAX_ARCHIVE_MEMBER_BYTES:
+            raise ArchiveError(f"'{filename}' exceeds the {MAX_ARCHIVE_MEMBER_BYTES // (1024 * 1024)} MB size limit.")
+        total_bytes += len(data)
+        if total_bytes > MAX_ARCHIVE_TOTAL_BYTES:
+            raise ArchiveError(f"Python files in the archive exceed the "
+                               f"{MAX_ARCHIVE_TOTAL_BYTES // (1024 * 1024)} MB total size limit.")
+        try:
+            code = data.decode('utf-8')
+        except UnicodeDecodeError:
+            raise ArchiveError(f"'{filename}' is not valid UTF-8.")
+        yield filename, code
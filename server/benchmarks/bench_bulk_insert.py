@@ -0,0 +1,67 @@
+"""比较 HistoryResult 的两种写入方式：逐条 db.add 与 save_history_results 的批量 executemany。
+
+在 server 目录下运行：python -m benchmarks.bench_bulk_insert [--pairs 80000]
+每种方式使用一个全新的临时 SQLite 文件，不会触碰 a.db。
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Base, HistoryResult
+from app.schemas import ComparisonResultItem
+from app.submissions import save_history_results
+
+
+def make_results(pairs: int):
+    task_id = str(uuid.uuid4())
+    rng = random.Random(0)
+    return [ComparisonResultItem(result_id=f"{task_id}-{i}", file1=f"student_{i % 400:03d}.py",
+                                 file2=f"student_{i // 400:03d}.py", similarity=rng.random(),
+                                 plagiarized=False, bounded=False)
+            for i in range(pairs)]
+
+
+def insert_one_by_one(db, history_id, results_list):
+    """改动前的写法。"""
+    for res in results_list:
+        db.add(HistoryResult(
+            history_id=history_id, result_id=res.result_id,
+            file1=res.file1, file2=res.file2, similarity=res.similarity,
+            plagiarized=res.plagiarized, bounded=res.bounded
+        ))
+    db.commit()
+
+
+def run(label, write, results_list):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        try:
+            start = time.perf_counter()
+            write(db, 1, results_list)
+            elapsed = time.perf_counter() - start
+            assert db.query(HistoryResult).count() == len(results_list)
+        finally:
+            db.close()
+            engine.dispose()
+    print(f"{label:<16} {len(results_list):>8} rows  {elapsed:8.2f} s  {len(results_list) / elapsed:>10.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=80000)
+    args = parser.parse_args()
+    results_list = make_results(args.pairs)
+    run("db.add loop", insert_one_by_one, results_list)
+    run("bulk insert", save_history_results, results_list)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
 from app.api import router
+from app.compression import GZIP_MIN_SIZE, GzipRequestMiddleware
 from app.database import create_db_and_tables
 
 create_db_and_tables()
@@ -10,6 +12,10 @@ app = FastAPI(
     version="1.1.0"
 )
 
+# 响应按客户端的 Accept-Encoding 压缩（SSE 事件流除外）；请求体可以用 gzip 压缩上传
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
+app.add_middleware(GzipRequestMiddleware)
+
 app.include_router(router, prefix="/api", tags=["Plagiarism Checker"])
 
 
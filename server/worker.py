@@ -0,0 +1,143 @@
+"""查重任务的独立 worker 进程：从 Job 表认领任务、执行打分、定期心跳并写回结果。
+
+在 server 目录下运行：python worker.py [--concurrency N]
+每个并发槽是一个独立进程，一次执行一个任务；单个任务内部的并行度仍由 /settings/worker_count 控制。
+收到 Ctrl+C / SIGTERM 后不再认领新任务，正在执行的任务完成后退出。
+启动时先把尚未入索引的提交补进索引；指纹格式变化后整个索引会重建。
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from app.api import execute_job, tasks_db
+from app.database import SessionLocal, create_db_and_tables, engine
+from app.jobs import (
+    claim_job, heartbeat_job, finish_job, fail_job, requeue_stale_jobs, JOB_HEARTBEAT_SECONDS, JOB_STALE_SECONDS
+)
+from app.submissions import backfill_index, reset_stale_index
+
+WORKER_CONCURRENCY = int(os.environ.get("SONAR_WORKER_CONCURRENCY", "1"))
+IDLE_POLL_INTERVAL = 1.0  # 队列为空时两次认领之间的间隔（秒）
+
+
+def report_progress(task_id: str, worker_id: str):
+    """把 tasks_db 中的进度和部分结果随心跳写入 Job 表。"""
+    task = tasks_db.get(task_id) or {}
+    partial_results = task.get('partial_results')
+    db = SessionLocal()
+    try:
+        heartbeat_job(db, task_id, worker_id, task.get('pairs_done'), task.get('pairs_total'),
+                      [item.model_dump() for item in partial_results] if partial_results else None)
+    finally:
+        db.close()
+
+
+def heartbeat_loop(task_id: str, worker_id: str, done: threading.Event):
+    while not done.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            report_progress(task_id, worker_id)
+        except Exception as e:
+            print(f"任务 {task_id} 心跳失败: {e}")
+
+
+def run_job(job):
+    task_id = job.task_id
+    print(f"[{job.worker_id}] 开始任务 {task_id} ({job.kind}, 优先级 {job.priority}, 第 {job.attempts} 次尝试)")
+    done = threading.Event()
+    heartbeat = threading.Thread(target=heartbeat_loop, args=(task_id, job.worker_id, done), daemon=True)
+    heartbeat.start()
+    db = SessionLocal()
+    try:
+        execute_job(task_id, job.kind, json.loads(job.payload))
+        task = tasks_db.get(task_id) or {}
+        features = None
+        if task.get('features'):
+            buffer = io.BytesIO()
+            np.save(buffer, task['features'][1])
+            features = buffer.getvalue()
+        if finish_job(db, task_id, job.worker_id, features):
+            print(f"[{job.worker_id}] 任务 {task_id} 已完成")
+        else:
+            print(f"[{job.worker_id}] 任务 {task_id} 已完成，但它已被重新排队，状态以新的执行为准")
+    except Exception as e:
+        traceback.print_exc()
+        fail_job(db, task_id, job.worker_id, str(e) or type(e).__name__)
+    finally:
+        done.set()
+        heartbeat.join()
+        tasks_db.discard(task_id)
+        db.close()
+
+
+def worker_loop(worker_id: str):
+    # fork 出的子进程不能复用父进程连接池中的 SQLite 连接
+    engine.dispose(close=False)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    last_reap = 0.0
+    while not stopping.is_set():
+        job = None
+        db = SessionLocal()
+        try:
+            if time.monotonic() - last_reap >= JOB_STALE_SECONDS / 2:
+                last_reap = time.monotonic()
+                requeued = requeue_stale_jobs(db)
+                if requeued:
+                    print(f"[{worker_id}] 重新排队 {requeued} 个心跳超时的任务")
+            job = claim_job(db, worker_id)
+            if job is not None:
+                db.expunge(job)
+        except Exception as e:
+            print(f"[{worker_id}] 认领任务失败: {e}")
+        finally:
+            db.close()
+        if job is None:
+            stopping.wait(IDLE_POLL_INTERVAL)
+            continue
+        run_job(job)
+    print(f"[{worker_id}] 已退出")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY,
+                        help="同时执行的任务数，每个任务一个进程")
+    args = parser.parse_args()
+    create_db_and_tables()
+    db = SessionLocal()
+    try:
+        if reset_stale_index(db):
+            print("指纹格式已更新，重建倒排索引")
+        backfilled = backfill_index(db)
+    finally:
+        db.close()
+    if backfilled:
+        print(f"已把 {backfilled} 份历史提交补入倒排索引")
+
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    if args.concurrency <= 1:
+        worker_loop(prefix)
+        return
+    processes = [multiprocessing.Process(target=worker_loop, args=(f"{prefix}-{slot}",))
+                 for slot in range(args.concurrency)]
+    for process in processes:
+        process.start()
+    # 子进程各自处理信号；父进程忽略 Ctrl+C，等待它们完成手头的任务
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: [p.terminate() for p in processes if p.is_alive()])
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()